@@ -1 +1,2 @@
 from .tools import map_reduce as map
+from .tools import pipeline
@@ -4,6 +4,7 @@ A dummy queue for testing qsub, qstat, and qdel.
 import os
 import pkg_resources
 import json
+import fcntl
 
 
 def resource_path(name):
@@ -13,13 +14,35 @@ def resource_path(name):
 
 
 QUEUE_STATE_PATH = resource_path("dummy_queue_state.json")
+QUEUE_STATE_LOCK_PATH = resource_path("dummy_queue_state.json.lock")
 QSUB_PATH = resource_path("dummy_qsub.py")
 QSTAT_PATH = resource_path("dummy_qstat.py")
 QDEL_PATH = resource_path("dummy_qdel.py")
 
 
-def init_queue_state(path, evil_jobs=[]):
+def init_queue_state(path, evil_jobs=[], halted_queues=[]):
+    """
+    Jobs pending in one of the halted_queues are never started.
+    """
     with open(path, "wt") as f:
         f.write(
-            json.dumps({"running": [], "pending": [], "evil_jobs": evil_jobs})
+            json.dumps(
+                {
+                    "running": [],
+                    "pending": [],
+                    "evil_jobs": evil_jobs,
+                    "halted_queues": halted_queues,
+                }
+            )
         )
+
+
+def lock_queue_state():
+    """
+    Returns an open lock-file which is locked exclusively. The lock is
+    released when the lock-file is closed, or when the process exits.
+    This allows to call the dummy qsub, qstat, and qdel in parallel.
+    """
+    lock_file = open(QUEUE_STATE_LOCK_PATH, "at")
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
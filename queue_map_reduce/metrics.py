@@ -0,0 +1,189 @@
+"""
+Metrics of the progress of map()
+--------------------------------
+
+While waiting for the jobs, map() updates the metrics after each call of
+qstat. The metrics can be appended as a json-line to a file, and can be
+written as a textfile for the prometheus node-exporter. Both allow to watch
+long campaigns on a dashboard.
+
+The runtime of a job is estimated from the time it was first seen running
+until it was seen neither running nor in error-state anymore. Jobs which
+finish in between two calls of qstat are not part of this estimate.
+"""
+import collections
+import json
+import math
+import time
+from . import network_file_system as nfs
+
+THROUGHPUT_WINDOW_S = 300.0
+RUNTIME_AVERAGE_WEIGHT = 0.1
+PROMETHEUS_PREFIX = "queue_map_reduce_"
+
+
+def init(session_id, num_jobs):
+    """
+    Returns the metrics of a session with num_jobs.
+    Keys starting with '_' are for book-keeping and are not exported.
+    """
+    now = time.time()
+    return {
+        "session_id": session_id,
+        "time": now,
+        "num_jobs": num_jobs,
+        "num_running": 0,
+        "num_pending": num_jobs,
+        "num_error": 0,
+        "num_lost": 0,
+        "num_finished": 0,
+        "jobs_per_minute": None,
+        "moving_average_runtime_s": None,
+        "eta_s": None,
+        "qstat_latency_s": None,
+        "bytes_written": 0,
+        "bytes_read": 0,
+        "_running_since": {},
+        "_num_finished_history": collections.deque([(now, 0)]),
+    }
+
+
+def update(
+    metrics,
+    JB_names_running,
+    JB_names_pending,
+    JB_names_error,
+    qstat_latency_s,
+    num_jobs_by_JB_name=None,
+    JB_names_lost=None,
+):
+    """
+    Updates the metrics with the JB_names found by the last call of qstat.
+    When a batch-job processes multiple jobs, num_jobs_by_JB_name tells how
+    many. The numbers of jobs running, pending, and so on count jobs, and
+    not batch-jobs.
+    The JB_names_lost will not be resubmitted anymore, e.g. because they
+    reached max_num_resubmissions. Their jobs are neither finished, nor
+    remaining.
+    """
+    if JB_names_lost is None:
+        JB_names_lost = set()
+    now = time.time()
+    running_since = metrics["_running_since"]
+
+    for JB_name in JB_names_running:
+        if JB_name not in running_since:
+            running_since[JB_name] = now
+
+    for JB_name in list(running_since.keys()):
+        if JB_name in JB_names_running:
+            continue
+        start = running_since.pop(JB_name)
+        if JB_name in JB_names_error:
+            continue
+        _add_runtime(metrics=metrics, runtime_s=now - start)
+
+    metrics["time"] = now
+    metrics["num_running"] = _num_jobs(JB_names_running, num_jobs_by_JB_name)
+    metrics["num_pending"] = _num_jobs(JB_names_pending, num_jobs_by_JB_name)
+    metrics["num_error"] = _num_jobs(JB_names_error, num_jobs_by_JB_name)
+    metrics["num_lost"] = _num_jobs(
+        JB_names_lost - JB_names_error, num_jobs_by_JB_name
+    )
+    metrics["num_finished"] = metrics["num_jobs"] - (
+        metrics["num_running"]
+        + metrics["num_pending"]
+        + metrics["num_error"]
+        + metrics["num_lost"]
+    )
+    metrics["qstat_latency_s"] = qstat_latency_s
+
+    history = metrics["_num_finished_history"]
+    history.append((now, metrics["num_finished"]))
+    while len(history) > 2 and now - history[0][0] > THROUGHPUT_WINDOW_S:
+        history.popleft()
+
+    oldest_time, oldest_num_finished = history[0]
+    if now > oldest_time:
+        metrics["jobs_per_minute"] = (
+            60.0
+            * (metrics["num_finished"] - oldest_num_finished)
+            / (now - oldest_time)
+        )
+    num_remaining = (
+        metrics["num_jobs"] - metrics["num_finished"] - metrics["num_lost"]
+    )
+    if num_remaining == 0:
+        metrics["eta_s"] = 0.0
+    elif metrics["jobs_per_minute"]:
+        metrics["eta_s"] = 60.0 * num_remaining / metrics["jobs_per_minute"]
+    else:
+        metrics["eta_s"] = None
+
+
+def _num_jobs(JB_names, num_jobs_by_JB_name):
+    if num_jobs_by_JB_name is None:
+        return len(JB_names)
+    return sum(num_jobs_by_JB_name.get(JB_name, 1) for JB_name in JB_names)
+
+
+def _add_runtime(metrics, runtime_s):
+    average = metrics["moving_average_runtime_s"]
+    if average is None:
+        metrics["moving_average_runtime_s"] = runtime_s
+    else:
+        metrics["moving_average_runtime_s"] = (
+            RUNTIME_AVERAGE_WEIGHT * runtime_s
+            + (1.0 - RUNTIME_AVERAGE_WEIGHT) * average
+        )
+
+
+def public(metrics):
+    """
+    Returns the metrics without the keys for book-keeping.
+    """
+    return {k: v for k, v in metrics.items() if not k.startswith("_")}
+
+
+def to_json_line(metrics):
+    return json.dumps(public(metrics)) + "\n"
+
+
+def to_prometheus_textfile(metrics):
+    """
+    Returns the metrics in the text-format of the prometheus node-exporter.
+    Metrics which are not known yet are 'NaN'.
+    """
+    pub = public(metrics)
+    labels = '{{session_id="{:s}"}}'.format(pub.pop("session_id"))
+    out = ""
+    for key in sorted(pub.keys()):
+        value = pub[key]
+        if value is None:
+            value = float("nan")
+        name = PROMETHEUS_PREFIX + key
+        out += "# TYPE {:s} gauge\n".format(name)
+        out += "{:s}{:s} {:s}\n".format(name, labels, _float_str(value))
+    return out
+
+
+def _float_str(value):
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+
+def export(metrics, json_lines_path=None, prometheus_textfile_path=None):
+    """
+    Appends the metrics as a json-line to json_lines_path, and writes the
+    prometheus textfile atomically to prometheus_textfile_path.
+    """
+    if json_lines_path is not None:
+        with open(json_lines_path, "at") as f:
+            f.write(to_json_line(metrics))
+    if prometheus_textfile_path is not None:
+        nfs.write(
+            content=to_prometheus_textfile(metrics),
+            path=prometheus_textfile_path,
+            mode="wt",
+        )
@@ -0,0 +1,153 @@
+"""
+Results written as numpy's .npy files
+-------------------------------------
+
+Large arrays are expensive to pickle, and to unpickle. With
+map(memory_map_results=True), the worker-node writes a result which is a
+numpy.ndarray in the .npy-format, and map() returns a read-only memory-map
+of it. So only the pages which are actually touched are read.
+
+A result which is a dict of numpy.ndarrays with string-keys is written into
+one .npy-file for each array, next to an index of the arrays. It is read
+back as a dict of memory-maps.
+
+All other results are pickled just like before.
+
+With map(stage_on_worker_node=True), the result is written into the
+worker-node's TMPDIR first, and is then moved into the work_dir. The arrays
+of a dict are moved before the index.
+
+Numpy is only imported when needed, it is not a requirement of
+queue_map_reduce.
+"""
+import json
+import os
+import pickle
+import uuid
+from . import network_file_system as nfs
+
+NPY_MAGIC = b"\x93NUMPY"
+NPY_DICT_MAGIC = b"\x93QMR_NPY_DICT\n"
+
+
+def _is_ndarray(obj):
+    """
+    Arrays of python-objects can not be memory-mapped, these are pickled.
+    """
+    if type(obj).__module__ != "numpy":
+        return False
+    if type(obj).__name__ not in ["ndarray", "memmap"]:
+        return False
+    return not obj.dtype.hasobject
+
+
+def _is_dict_of_ndarrays(obj):
+    if not isinstance(obj, dict) or len(obj) == 0:
+        return False
+    for key in obj:
+        if not isinstance(key, str) or not _is_ndarray(obj[key]):
+            return False
+    return True
+
+
+def _write_npy(array, path):
+    import numpy
+
+    tmp_path = "{:s}.{:s}.tmp".format(path, uuid.uuid4().__str__())
+    with open(tmp_path, "wb") as f:
+        numpy.save(f, array, allow_pickle=False)
+    nfs.move(src=tmp_path, dst=path)
+
+
+def write(result, path):
+    """
+    Writes the result to path. The arrays of a dict are written to
+    path.{i:d}.npy before the index is written to path. So the result is
+    complete once path exists.
+    """
+    if _is_ndarray(result):
+        _write_npy(array=result, path=path)
+    elif _is_dict_of_ndarrays(result):
+        filenames = {}
+        for i, key in enumerate(result):
+            filename = "{:s}.{:d}.npy".format(os.path.basename(path), i)
+            _write_npy(
+                array=result[key],
+                path=os.path.join(os.path.dirname(path), filename),
+            )
+            filenames[key] = filename
+        nfs.write(
+            content=NPY_DICT_MAGIC + json.dumps(filenames).encode(),
+            path=path,
+            mode="wb",
+        )
+    else:
+        nfs.write(content=pickle.dumps(result), path=path, mode="wb")
+
+
+def read(path):
+    """
+    Returns the result in path. Arrays are returned as read-only
+    memory-maps.
+    """
+    with open(path, "rb") as f:
+        head = f.read(len(NPY_DICT_MAGIC))
+        rest = b"" if head.startswith(NPY_MAGIC) else f.read()
+
+    if head.startswith(NPY_MAGIC):
+        import numpy
+
+        return numpy.load(path, mmap_mode="r", allow_pickle=False)
+    if head != NPY_DICT_MAGIC:
+        return pickle.loads(head + rest)
+
+    import numpy
+
+    filenames = json.loads(rest.decode())
+    out = {}
+    for key in filenames:
+        out[key] = numpy.load(
+            os.path.join(os.path.dirname(path), filenames[key]),
+            mmap_mode="r",
+            allow_pickle=False,
+        )
+    return out
+
+
+def _array_filenames(path):
+    """
+    Returns the filenames of the arrays of a dict written to path, relative
+    to the directory of path. This is empty for all other results.
+    """
+    with open(path, "rb") as f:
+        head = f.read(len(NPY_DICT_MAGIC))
+        if head != NPY_DICT_MAGIC:
+            return []
+        filenames = json.loads(f.read().decode())
+    return list(filenames.values())
+
+
+def move(src, dst):
+    """
+    Moves the result from src to dst, e.g. from the worker-node's TMPDIR
+    into the work_dir. The basenames of src and dst must be equal. The arrays
+    of a dict are moved before the index. So the result is complete once dst
+    exists.
+    """
+    assert os.path.basename(src) == os.path.basename(dst)
+    for filename in _array_filenames(src):
+        nfs.move(
+            src=os.path.join(os.path.dirname(src), filename),
+            dst=os.path.join(os.path.dirname(dst), filename),
+        )
+    nfs.move(src=src, dst=dst)
+
+
+def num_bytes(path):
+    """
+    Returns the size of the result in path, including the arrays of a dict.
+    """
+    size = os.stat(path).st_size
+    for filename in _array_filenames(path):
+        size += os.stat(os.path.join(os.path.dirname(path), filename)).st_size
+    return size
@@ -0,0 +1,161 @@
+"""
+Spreading the jobs of a session across multiple queues
+------------------------------------------------------
+
+When map() is given a list of queues, each batch-job is submitted to one of
+them. The split follows the weights of the queues. The weight of a queue is
+proportional to its progress. This is the fraction of the transitions from
+pending to running, and from running to finished, which the jobs submitted
+to the queue already made. A queue which starts and finishes its jobs
+faster gets a larger weight. A queue which was not given any job yet gets
+the mean progress of the other queues, so it is neither favored nor avoided.
+The weights are updated after each call of qstat, so later submissions,
+e.g. resubmissions, shift toward the faster queues.
+
+Optionally, the jobs which are still pending in a queue with a weight below
+MOVE_WEIGHT_RATIO times the largest weight are moved to the queue with the
+largest weight. Nothing is moved before a job in the queue with the
+largest weight started, or finished. Each job is moved only once, so that no
+job bounces between the queues.
+"""
+
+MOVE_WEIGHT_RATIO = 0.5
+
+
+def init(queue_names):
+    """
+    Returns the balancer for the queues in queue_names.
+    Keys starting with '_' are for book-keeping.
+    """
+    assert len(queue_names) > 0
+    num_queues = len(queue_names)
+    return {
+        "queue_names": list(queue_names),
+        "num_submitted": {q: 0 for q in queue_names},
+        "num_started": {q: 0 for q in queue_names},
+        "num_finished": {q: 0 for q in queue_names},
+        "weights": {q: 1.0 / num_queues for q in queue_names},
+        "_credits": {q: 0.0 for q in queue_names},
+        "_queue_name_by_JB_name": {},
+        "_in_queue": set(),
+        "_started": set(),
+        "_moved": set(),
+    }
+
+
+def assign(balancer, batch_jobs):
+    """
+    Sets the 'queue_name' of each batch-job. The queues are picked in a
+    smooth weighted round-robin. So even a few batch-jobs are split
+    according to the weights.
+    """
+    credits = balancer["_credits"]
+    for batch_job in batch_jobs:
+        for queue_name in balancer["queue_names"]:
+            credits[queue_name] += balancer["weights"][queue_name]
+        best = max(balancer["queue_names"], key=lambda q: credits[q])
+        credits[best] -= 1.0
+        _submitted(balancer=balancer, batch_job=batch_job, queue_name=best)
+
+
+def _submitted(balancer, batch_job, queue_name):
+    JB_name = batch_job["JB_name"]
+    batch_job["queue_name"] = queue_name
+    balancer["num_submitted"][queue_name] += 1
+    balancer["_queue_name_by_JB_name"][JB_name] = queue_name
+    balancer["_in_queue"].add(JB_name)
+    balancer["_started"].discard(JB_name)
+
+
+def update(balancer, JB_names_running, JB_names_pending, JB_names_error):
+    """
+    Counts the transitions of the jobs since the last call of qstat, and
+    updates the weights. A job which is neither running, pending, nor in
+    error-state anymore is finished. A job which finished between two
+    calls of qstat also counts as started.
+    A job in error-state is not counted. When it is resubmitted, it is
+    assigned to a queue again.
+    """
+    for JB_name in list(balancer["_in_queue"]):
+        queue_name = balancer["_queue_name_by_JB_name"][JB_name]
+        if JB_name in JB_names_pending:
+            continue
+        if JB_name in JB_names_error:
+            balancer["_in_queue"].remove(JB_name)
+            continue
+        if JB_name not in balancer["_started"]:
+            balancer["_started"].add(JB_name)
+            balancer["num_started"][queue_name] += 1
+        if JB_name not in JB_names_running:
+            balancer["_in_queue"].remove(JB_name)
+            balancer["num_finished"][queue_name] += 1
+
+    progress = {}
+    for q in balancer["queue_names"]:
+        if balancer["num_submitted"][q] > 0:
+            progress[q] = (
+                balancer["num_started"][q] + balancer["num_finished"][q] + 1
+            ) / (2 * balancer["num_submitted"][q] + 1)
+    if progress:
+        mean_progress = sum(progress.values()) / len(progress)
+    else:
+        mean_progress = 1.0
+    for q in balancer["queue_names"]:
+        if q not in progress:
+            progress[q] = mean_progress
+    total = sum(progress.values())
+    for q in balancer["queue_names"]:
+        balancer["weights"][q] = progress[q] / total
+
+
+def fastest_queue_name(balancer):
+    return max(balancer["queue_names"], key=lambda q: balancer["weights"][q])
+
+
+def JB_names_to_move(balancer, JB_names_pending):
+    """
+    Returns the JB_names of the pending jobs which should be moved to the
+    fastest queue. These are in a queue with a weight below
+    MOVE_WEIGHT_RATIO times the largest weight, and were not moved before.
+    Nothing is moved as long as no job in the fastest queue started. A job
+    which finished also counts as started.
+    """
+    fastest = fastest_queue_name(balancer)
+    if balancer["num_started"][fastest] == 0:
+        return []
+    threshold = MOVE_WEIGHT_RATIO * balancer["weights"][fastest]
+    to_move = []
+    for JB_name in sorted(JB_names_pending):
+        if JB_name in balancer["_moved"]:
+            continue
+        queue_name = balancer["_queue_name_by_JB_name"][JB_name]
+        if balancer["weights"][queue_name] < threshold:
+            to_move.append(JB_name)
+    return to_move
+
+
+def move(balancer, batch_jobs):
+    """
+    Assigns the batch-jobs to the fastest queue, and remembers that they
+    were moved.
+    """
+    fastest = fastest_queue_name(balancer)
+    for batch_job in batch_jobs:
+        balancer["_moved"].add(batch_job["JB_name"])
+        _submitted(balancer=balancer, batch_job=batch_job, queue_name=fastest)
+
+
+def to_str(balancer):
+    out = []
+    for q in balancer["queue_names"]:
+        out.append(
+            "{:s}: weight {:.3f}, {:d} submitted, {:d} started, "
+            "{:d} finished".format(
+                str(q),
+                balancer["weights"][q],
+                balancer["num_submitted"][q],
+                balancer["num_started"][q],
+                balancer["num_finished"][q],
+            )
+        )
+    return "; ".join(out)
@@ -6,35 +6,38 @@ from queue_map_reduce import dummy_queue
 
 # dummy qdel
 # ==========
-assert len(sys.argv) == 2
-JB_job_number = sys.argv[1]
+assert len(sys.argv) >= 2
+JB_job_numbers = set(sys.argv[1:])
+
+queue_state_lock = dummy_queue.lock_queue_state()
 
 with open(dummy_queue.QUEUE_STATE_PATH, "rt") as f:
     old_state = json.loads(f.read())
 
-found = False
+found = set()
 state = {
     "pending": [],
     "running": [],
     "evil_jobs": old_state["evil_jobs"],
+    "halted_queues": old_state["halted_queues"],
 }
 for job in old_state["running"]:
-    if job["JB_job_number"] == JB_job_number:
-        found = True
+    if job["JB_job_number"] in JB_job_numbers:
+        found.add(job["JB_job_number"])
     else:
         state["running"].append(job)
 
 for job in old_state["pending"]:
-    if job["JB_job_number"] == JB_job_number:
-        found = True
+    if job["JB_job_number"] in JB_job_numbers:
+        found.add(job["JB_job_number"])
     else:
         state["pending"].append(job)
 
 with open(dummy_queue.QUEUE_STATE_PATH, "wt") as f:
     f.write(json.dumps(state, indent=4))
 
-if found == True:
+if found == JB_job_numbers:
     sys.exit(0)
 else:
-    print("Can not find ", JB_job_number)
+    print("Can not find ", JB_job_numbers - found)
     sys.exit(1)
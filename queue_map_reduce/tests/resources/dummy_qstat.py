@@ -69,6 +69,8 @@ MAX_NUM_RUNNING = 10
 assert len(sys.argv) == 2
 assert sys.argv[1] == "-xml"
 
+queue_state_lock = dummy_queue.lock_queue_state()
+
 with open(dummy_queue.QUEUE_STATE_PATH, "rt") as f:
     state = json.loads(f.read())
 
@@ -79,11 +81,17 @@ for evil in state["evil_jobs"]:
     evil_idxs_max_num_fails[evil["idx"]] = evil["max_num_fails"]
 
 
+startable = []
+for i, job in enumerate(state["pending"]):
+    if job["queue_name"] not in state["halted_queues"]:
+        startable.append(i)
+
+
 if len(state["running"]) >= MAX_NUM_RUNNING:
     run_job = state["running"].pop(0)
     actually_run_the_job(run_job)
-elif len(state["pending"]) > 0:
-    job = state["pending"].pop(0)
+elif len(startable) > 0:
+    job = state["pending"].pop(startable[0])
     idx = qmr.tools._idx_from_JB_name(job["JB_name"])
     if idx in evil_idxs_num_fails:
         if evil_idxs_num_fails[idx] < evil_idxs_max_num_fails[idx]:
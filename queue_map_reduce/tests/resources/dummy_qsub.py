@@ -15,12 +15,16 @@ parser.add_argument("-e", type=str, help="stderr path")
 parser.add_argument("-N", type=str, help="JB_name")
 parser.add_argument("-V", action="store_true", help="export environment")
 parser.add_argument("-S", type=str, help="path of script")
+parser.add_argument("-l", type=str, help="hard resource list")
+parser.add_argument("-pe", nargs=2, help="parallel environment and slots")
 parser.add_argument("script_args", nargs="*", default=None)
 
 args = parser.parse_args()
 
 assert len(args.script_args) == 2
 
+queue_state_lock = dummy_queue.lock_queue_state()
+
 with open(dummy_queue.QUEUE_STATE_PATH, "rt") as f:
     state = json.loads(f.read())
 
@@ -36,7 +40,8 @@ job = {
     "state": "qw",
     "JB_submission_time": now.isoformat(),
     "queue_name": str(args.q),
-    "slots": "1",
+    "slots": args.pe[1] if args.pe else "1",
+    "_hard_resource_list": str(args.l),
     "_opath": args.o,
     "_epath": args.e,
     "_python_path": args.S,
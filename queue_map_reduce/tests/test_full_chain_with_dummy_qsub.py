@@ -2,6 +2,8 @@ import queue_map_reduce as qmr
 from queue_map_reduce import dummy_queue
 import numpy as np
 import tempfile
+import json
+import time
 import os
 
 
@@ -47,3 +49,75 @@ def test_run_with_failing_job():
 
         for i in range(NUM_JOBS):
             assert results[i] == np.sum(jobs[i])
+
+
+def test_run_with_many_failing_jobs_and_parallel_qsub():
+    """
+    Several jobs go into error-state in the same polling-cycle.
+    They are deleted with a single call of qdel and resubmitted using
+    parallel calls of qsub.
+    """
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp_dir:
+        qsub_tmp_dir = os.path.join(tmp_dir, "qsub_tmp")
+
+        evil_jobs = []
+        for idx in [3, 4, 5, 17]:
+            evil_jobs.append({"idx": idx, "num_fails": 0, "max_num_fails": 2})
+        dummy_queue.init_queue_state(
+            path=dummy_queue.QUEUE_STATE_PATH, evil_jobs=evil_jobs,
+        )
+
+        NUM_JOBS = 20
+        jobs = [np.arange(i, 100 + i) for i in range(NUM_JOBS)]
+
+        results = qmr.map(
+            function=np.sum,
+            jobs=jobs,
+            polling_interval_qstat=0.1,
+            work_dir=qsub_tmp_dir,
+            keep_work_dir=True,
+            max_num_resubmissions=3,
+            qsub_path=dummy_queue.QSUB_PATH,
+            qstat_path=dummy_queue.QSTAT_PATH,
+            qdel_path=dummy_queue.QDEL_PATH,
+            error_state_indicator="E",
+            qsub_num_threads=4,
+            max_num_trials_qsub_qdel=3,
+        )
+
+        for i in range(NUM_JOBS):
+            assert results[i] == np.sum(jobs[i])
+
+
+def test_qdel_retries_only_jobs_still_in_queue():
+    dummy_queue.init_queue_state(path=dummy_queue.QUEUE_STATE_PATH)
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        batch_job = qmr.tools._make_batch_job(
+            JB_name=qmr.tools._make_JB_name(session_id="qdel", idx=0),
+            script_path=os.path.join(tmp, "worker_node_script.py"),
+            job_path=qmr.tools._job_path(tmp, 0),
+        )
+        qmr.tools._qsub_batch_job(
+            batch_job=batch_job,
+            qsub_path=dummy_queue.QSUB_PATH,
+            queue_name=None,
+            python_path="python",
+        )
+        with open(dummy_queue.QUEUE_STATE_PATH, "rt") as f:
+            state = json.loads(f.read())
+        JB_job_number = state["pending"][0]["JB_job_number"]
+
+        start = time.time()
+        not_deleted = qmr.tools._qdel(
+            JB_job_numbers=[JB_job_number, "123"],
+            qdel_path=dummy_queue.QDEL_PATH,
+            qstat_path=dummy_queue.QSTAT_PATH,
+            max_num_trials=10,
+        )
+        assert not_deleted == []
+        assert time.time() - start < 1.0
+
+        with open(dummy_queue.QUEUE_STATE_PATH, "rt") as f:
+            state = json.loads(f.read())
+        assert len(state["pending"]) == 0
+        assert len(state["running"]) == 0
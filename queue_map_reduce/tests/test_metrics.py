@@ -0,0 +1,123 @@
+from queue_map_reduce import metrics
+import json
+import tempfile
+import os
+
+
+def test_update_counts_and_eta():
+    m = metrics.init(session_id="hans", num_jobs=4)
+    metrics.update(
+        metrics=m,
+        JB_names_running={"a", "b"},
+        JB_names_pending={"c", "d"},
+        JB_names_error=set(),
+        qstat_latency_s=0.1,
+    )
+    assert m["num_running"] == 2
+    assert m["num_pending"] == 2
+    assert m["num_finished"] == 0
+    assert m["moving_average_runtime_s"] is None
+    assert m["qstat_latency_s"] == 0.1
+
+    metrics.update(
+        metrics=m,
+        JB_names_running={"c"},
+        JB_names_pending={"d"},
+        JB_names_error={"b"},
+        qstat_latency_s=0.2,
+    )
+    assert m["num_finished"] == 1
+    assert m["num_error"] == 1
+    assert m["moving_average_runtime_s"] >= 0.0
+    assert m["jobs_per_minute"] > 0.0
+    assert m["eta_s"] > 0.0
+
+    metrics.update(
+        metrics=m,
+        JB_names_running=set(),
+        JB_names_pending=set(),
+        JB_names_error=set(),
+        qstat_latency_s=0.2,
+    )
+    assert m["num_finished"] == 4
+    assert m["eta_s"] == 0.0
+
+
+def test_export():
+    m = metrics.init(session_id="hans", num_jobs=4)
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        json_lines_path = os.path.join(tmp, "metrics.jsonl")
+        prometheus_path = os.path.join(tmp, "metrics.prom")
+        metrics.export(
+            metrics=m,
+            json_lines_path=json_lines_path,
+            prometheus_textfile_path=prometheus_path,
+        )
+        metrics.export(metrics=m, json_lines_path=json_lines_path)
+
+        with open(json_lines_path, "rt") as f:
+            lines = f.read().splitlines()
+        assert len(lines) == 2
+        record = json.loads(lines[0])
+        assert record["num_jobs"] == 4
+        assert "_running_since" not in record
+
+        with open(prometheus_path, "rt") as f:
+            text = f.read()
+        assert 'queue_map_reduce_num_jobs{session_id="hans"} 4.0' in text
+        assert 'queue_map_reduce_eta_s{session_id="hans"} NaN' in text
+
+
+def test_update_counts_jobs_in_bundles():
+    m = metrics.init(session_id="hans", num_jobs=7)
+    num_jobs_by_JB_name = {"a": 4, "b": 3}
+    metrics.update(
+        metrics=m,
+        JB_names_running={"a"},
+        JB_names_pending={"b"},
+        JB_names_error=set(),
+        qstat_latency_s=0.1,
+        num_jobs_by_JB_name=num_jobs_by_JB_name,
+    )
+    assert m["num_running"] == 4
+    assert m["num_pending"] == 3
+    assert m["num_finished"] == 0
+
+    metrics.update(
+        metrics=m,
+        JB_names_running={"b"},
+        JB_names_pending=set(),
+        JB_names_error=set(),
+        qstat_latency_s=0.1,
+        num_jobs_by_JB_name=num_jobs_by_JB_name,
+    )
+    assert m["num_running"] == 3
+    assert m["num_finished"] == 4
+
+
+def test_lost_jobs_are_not_finished():
+    m = metrics.init(session_id="hans", num_jobs=3)
+    metrics.update(
+        metrics=m,
+        JB_names_running={"a"},
+        JB_names_pending=set(),
+        JB_names_error={"b"},
+        qstat_latency_s=0.1,
+        JB_names_lost={"b"},
+    )
+    assert m["num_error"] == 1
+    assert m["num_lost"] == 0
+    assert m["num_finished"] == 1
+
+    metrics.update(
+        metrics=m,
+        JB_names_running=set(),
+        JB_names_pending=set(),
+        JB_names_error=set(),
+        qstat_latency_s=0.1,
+        JB_names_lost={"b"},
+    )
+    assert m["num_lost"] == 1
+    assert m["num_finished"] == 2
+    assert m["eta_s"] == 0.0
+    assert "queue_map_reduce_num_lost" in metrics.to_prometheus_textfile(m)
@@ -0,0 +1,66 @@
+from queue_map_reduce import npy_results
+import numpy
+import tempfile
+import os
+
+
+def test_array_is_memory_mapped():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        path = os.path.join(tmp, "000000000.pkl.out")
+        array = numpy.arange(1000, dtype=numpy.float32).reshape((10, 100))
+        npy_results.write(result=array, path=path)
+        result = npy_results.read(path=path)
+        assert isinstance(result, numpy.memmap)
+        assert not result.flags.writeable
+        numpy.testing.assert_array_equal(result, array)
+
+
+def test_dict_of_arrays_is_memory_mapped():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        path = os.path.join(tmp, "000000000.pkl.out")
+        arrays = {"a": numpy.arange(10), "b": numpy.ones((3, 3))}
+        npy_results.write(result=arrays, path=path)
+        assert os.path.exists(path + ".0.npy")
+        assert os.path.exists(path + ".1.npy")
+        result = npy_results.read(path=path)
+        assert set(result.keys()) == {"a", "b"}
+        for key in arrays:
+            assert isinstance(result[key], numpy.memmap)
+            numpy.testing.assert_array_equal(result[key], arrays[key])
+
+
+def test_other_results_are_pickled():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        path = os.path.join(tmp, "000000000.pkl.out")
+        for other in [
+            42,
+            {"a": numpy.arange(3), "b": "no array"},
+            numpy.array([{}, None], dtype=object),
+        ]:
+            npy_results.write(result=other, path=path)
+            result = npy_results.read(path=path)
+            assert not isinstance(result, numpy.memmap)
+            assert str(result) == str(other)
+
+
+def test_move_dict_of_arrays_and_count_its_bytes():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        os.makedirs(os.path.join(tmp, "local"))
+        os.makedirs(os.path.join(tmp, "work_dir"))
+        src = os.path.join(tmp, "local", "000000000.pkl.out")
+        dst = os.path.join(tmp, "work_dir", "000000000.pkl.out")
+        arrays = {"a": numpy.arange(10), "b": numpy.ones((3, 3))}
+        npy_results.write(result=arrays, path=src)
+        num_bytes = npy_results.num_bytes(path=src)
+        assert num_bytes == (
+            os.stat(src).st_size
+            + os.stat(src + ".0.npy").st_size
+            + os.stat(src + ".1.npy").st_size
+        )
+
+        npy_results.move(src=src, dst=dst)
+        assert os.listdir(os.path.join(tmp, "local")) == []
+        assert npy_results.num_bytes(path=dst) == num_bytes
+        result = npy_results.read(path=dst)
+        for key in arrays:
+            numpy.testing.assert_array_equal(result[key], arrays[key])
@@ -1,11 +1,18 @@
 import queue_map_reduce as qmr
 from queue_map_reduce import tools as qmr_tools
 from queue_map_reduce import dummy_queue as dummy
+from queue_map_reduce import queue_balancer
+from queue_map_reduce import npy_results
 import pickle
 import numpy
+import pytest
 import tempfile
 import os
 import subprocess
+import operator
+import json
+import time
+import sys
 
 
 NUM_JOBS = 10
@@ -143,3 +150,806 @@ def test_minimal_example():
     jobs = [numpy.arange(i, 100 + i) for i in range(10)]
     for idx in range(len(results)):
         assert results[idx] == numpy.sum(jobs[idx])
+
+
+def test_reduce_with_parallel_workers():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(path=dummy.QUEUE_STATE_PATH)
+        results = qmr.map(
+            function=GOOD_FUNCTION,
+            jobs=GOOD_JOBS,
+            work_dir=os.path.join(tmp, "my_work_dir"),
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            reduce_num_workers=4,
+        )
+
+        assert len(results) == NUM_JOBS
+        for i in range(NUM_JOBS):
+            assert results[i] == GOOD_FUNCTION(GOOD_JOBS[i])
+
+
+def test_reduce_with_fold_function():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(path=dummy.QUEUE_STATE_PATH)
+        total = qmr.map(
+            function=GOOD_FUNCTION,
+            jobs=GOOD_JOBS,
+            work_dir=os.path.join(tmp, "my_work_dir"),
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            reduce_num_workers=2,
+            reducer=(0, operator.add),
+        )
+
+        assert total == sum([GOOD_FUNCTION(job) for job in GOOD_JOBS])
+
+
+def test_make_reduce_node_script():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        paths = []
+        for i in range(3):
+            path = os.path.join(tmp, "{:09d}.pkl.out".format(i))
+            with open(path, "wb") as f:
+                f.write(pickle.dumps(numpy.arange(i, i + 5)))
+            paths.append(path)
+        reduce_job_path = os.path.join(tmp, "reduce_job.pkl")
+        with open(reduce_job_path, "wb") as f:
+            f.write(pickle.dumps({"initial": 0, "paths": paths}))
+        s = qmr_tools._make_reduce_node_script(
+            module_name=numpy.add.__module__,
+            function_name=numpy.add.__name__,
+            environ={},
+        )
+        script_path = os.path.join(tmp, "reduce_node_script.py")
+        with open(script_path, "wt") as f:
+            f.write(s)
+        rc = subprocess.call(["python", script_path, reduce_job_path])
+        assert rc == 0
+        with open(reduce_job_path + ".out", "rb") as f:
+            accumulator = pickle.loads(f.read())
+        expected = numpy.arange(0, 5) + numpy.arange(1, 6) + numpy.arange(2, 7)
+        numpy.testing.assert_array_equal(accumulator, expected)
+
+
+def test_tree_reduce_on_queue():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(path=dummy.QUEUE_STATE_PATH)
+        total, stats = qmr.map(
+            function=GOOD_FUNCTION,
+            jobs=GOOD_JOBS,
+            work_dir=os.path.join(tmp, "my_work_dir"),
+            keep_work_dir=True,
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            reducer=(0, numpy.add),
+            tree_reduce_group_size=3,
+            return_stats=True,
+        )
+
+        assert total == sum([GOOD_FUNCTION(job) for job in GOOD_JOBS])
+        assert stats["submitting"]["count"] == NUM_JOBS
+        # 10 results, 4 and 2 accumulators, then a single one.
+        assert stats["tree_reduce_submitting"]["count"] == 4 + 2 + 1
+        assert stats["tree_reduce_waiting"]["count"] > 0
+        assert stats["reducing"]["bytes"] > 0
+        for level in range(3):
+            level_dir = os.path.join(
+                tmp, "my_work_dir", "reduce_{:02d}".format(level)
+            )
+            assert os.path.exists(level_dir)
+
+
+def test_shared_payload():
+    shared = numpy.arange(100)
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(path=dummy.QUEUE_STATE_PATH)
+        results = qmr.map(
+            function=numpy.add,
+            jobs=GOOD_JOBS,
+            work_dir=os.path.join(tmp, "my_work_dir"),
+            keep_work_dir=True,
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            shared=shared,
+        )
+
+        assert os.path.exists(os.path.join(tmp, "my_work_dir", "shared.pkl"))
+        assert len(results) == NUM_JOBS
+        for i in range(NUM_JOBS):
+            numpy.testing.assert_array_equal(
+                results[i], numpy.add(GOOD_JOBS[i], shared)
+            )
+
+
+def test_make_worker_node_script_with_staging():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        work_dir = os.path.join(tmp, "work_dir")
+        worker_node_tmp_dir = os.path.join(tmp, "worker_node_tmp_dir")
+        os.makedirs(work_dir)
+        os.makedirs(worker_node_tmp_dir)
+
+        work = numpy.arange(100)
+        function = numpy.sum
+        job_path = os.path.join(work_dir, "work.pkl")
+        with open(job_path, "wb") as f:
+            f.write(pickle.dumps(work))
+        s = qmr_tools._make_worker_node_script(
+            module_name=function.__module__,
+            function_name=function.__name__,
+            environ={},
+            stage=True,
+        )
+        script_path = os.path.join(work_dir, "worker_node_script.py")
+        with open(script_path, "wt") as f:
+            f.write(s)
+        env = dict(os.environ)
+        env["TMPDIR"] = worker_node_tmp_dir
+        rc = subprocess.call(["python", script_path, job_path], env=env)
+        assert rc == 0
+        assert not os.path.exists(
+            os.path.join(worker_node_tmp_dir, "work.pkl")
+        )
+        assert not os.path.exists(
+            os.path.join(worker_node_tmp_dir, "work.pkl.out")
+        )
+        with open(job_path + ".out", "rb") as f:
+            result = pickle.loads(f.read())
+        assert result == function(work)
+
+
+def test_make_worker_node_script_stage_npy_results():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        work_dir = os.path.join(tmp, "work_dir")
+        worker_node_tmp_dir = os.path.join(tmp, "worker_node_tmp_dir")
+        os.makedirs(work_dir)
+        os.makedirs(worker_node_tmp_dir)
+
+        work = numpy.arange(100)
+        function = numpy.cumsum
+        job_path = os.path.join(work_dir, "work.pkl")
+        with open(job_path, "wb") as f:
+            f.write(pickle.dumps(work))
+        s = qmr_tools._make_worker_node_script(
+            module_name=function.__module__,
+            function_name=function.__name__,
+            environ={},
+            stage=True,
+            npy_results=True,
+        )
+        script_path = os.path.join(work_dir, "worker_node_script.py")
+        with open(script_path, "wt") as f:
+            f.write(s)
+        env = dict(os.environ)
+        env["TMPDIR"] = worker_node_tmp_dir
+        rc = subprocess.call(["python", script_path, job_path], env=env)
+        assert rc == 0
+        assert os.listdir(worker_node_tmp_dir) == []
+        result = npy_results.read(job_path + ".out")
+        assert isinstance(result, numpy.memmap)
+        numpy.testing.assert_array_equal(result, function(work))
+
+
+def test_resources_arguments():
+    resources = qmr_tools._make_resources(
+        memory_bytes=2e9,
+        runtime_s=3600,
+        num_slots=4,
+        parallel_environment="smp",
+    )
+    assert qmr_tools._make_resources_arguments(resources) == [
+        "-l",
+        "h_vmem=2000000000,h_rt=3600",
+        "-pe",
+        "smp",
+        "4",
+    ]
+    none = qmr_tools._make_resources(None, None, 1, None)
+    assert qmr_tools._make_resources_arguments(none) == []
+
+
+def test_escalate_resources():
+    resources = qmr_tools._make_resources(1000, 60, 1, None)
+    usage_summary = qmr_tools._init_usage_summary()
+
+    escalated = qmr_tools._escalate_resources(
+        resources=resources, factor=2.0, usage_summary=usage_summary,
+    )
+    assert escalated["h_vmem"] == 2000
+    assert escalated["h_rt"] == 120
+
+    usage_summary["num"] = 10
+    usage_summary["max_peak_memory_bytes"] = 4000
+    usage_summary["max_wall_time_s"] = 10.0
+    escalated = qmr_tools._escalate_resources(
+        resources=resources, factor=2.0, usage_summary=usage_summary,
+    )
+    assert escalated["h_vmem"] == 5000
+    assert escalated["h_rt"] == 120
+
+
+def test_full_chain_with_resources():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(
+            path=dummy.QUEUE_STATE_PATH,
+            evil_jobs=[{"idx": 3, "num_fails": 0, "max_num_fails": 2}],
+        )
+        results = qmr.map(
+            function=GOOD_FUNCTION,
+            jobs=GOOD_JOBS,
+            work_dir=os.path.join(tmp, "my_work_dir"),
+            keep_work_dir=True,
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            job_memory_bytes=1e9,
+            job_runtime_s=600,
+        )
+
+        assert len(results) == NUM_JOBS
+        for i in range(NUM_JOBS):
+            assert results[i] == GOOD_FUNCTION(GOOD_JOBS[i])
+            usage_path = qmr_tools._job_path(
+                os.path.join(tmp, "my_work_dir"), i
+            )
+            with open(usage_path + ".usage", "rt") as f:
+                usage = json.loads(f.read())
+            assert usage["peak_memory_bytes"] > 0
+            assert usage["wall_time_s"] >= 0.0
+
+        with open(
+            os.path.join(
+                tmp, "my_work_dir", "num_resubmissions_by_JB_name.json"
+            ),
+            "rt",
+        ) as f:
+            num_resubmissions_by_JB_name = json.loads(f.read())
+        assert len(num_resubmissions_by_JB_name) == 1
+        for JB_name in num_resubmissions_by_JB_name:
+            assert qmr_tools._idx_from_JB_name(JB_name) == 3
+            assert num_resubmissions_by_JB_name[JB_name] == 2
+
+
+def test_resources_stay_flat_after_max_num_resource_escalations():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(
+            path=dummy.QUEUE_STATE_PATH,
+            evil_jobs=[{"idx": 3, "num_fails": 0, "max_num_fails": 6}],
+        )
+        # This qsub logs its arguments before it calls the dummy qsub.
+        qsub_log_path = os.path.join(tmp, "qsub.jsonl")
+        logging_qsub_path = os.path.join(tmp, "logging_qsub.py")
+        with open(logging_qsub_path, "wt") as f:
+            f.write(
+                "#!{:s}\n"
+                "import json, subprocess, sys\n"
+                "with open({:s}, 'at') as f:\n"
+                "    f.write(json.dumps(sys.argv[1:]) + '\\n')\n"
+                "sys.exit(subprocess.call([{:s}] + sys.argv[1:]))\n".format(
+                    sys.executable,
+                    repr(qsub_log_path),
+                    repr(dummy.QSUB_PATH),
+                )
+            )
+        os.chmod(logging_qsub_path, 0o755)
+
+        results = qmr.map(
+            function=GOOD_FUNCTION,
+            jobs=GOOD_JOBS,
+            work_dir=os.path.join(tmp, "my_work_dir"),
+            polling_interval_qstat=1e-3,
+            qsub_path=logging_qsub_path,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            job_memory_bytes=1e9,
+            job_runtime_s=600,
+            resource_escalation_factor=2.0,
+            max_num_resource_escalations=3,
+        )
+
+        assert results[3] == GOOD_FUNCTION(GOOD_JOBS[3])
+        hard_resource_lists = []
+        with open(qsub_log_path, "rt") as f:
+            for line in f:
+                args = json.loads(line)
+                if args[args.index("-N") + 1].endswith("{:09d}".format(3)):
+                    hard_resource_lists.append(args[args.index("-l") + 1])
+        assert len(hard_resource_lists) == 1 + 6
+        assert hard_resource_lists[0] == "h_vmem=1000000000,h_rt=600"
+        assert hard_resource_lists[3] == "h_vmem=8000000000,h_rt=4800"
+        for hard_resource_list in hard_resource_lists[3:]:
+            assert hard_resource_list == hard_resource_lists[3]
+
+
+def test_full_chain_with_metrics():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(path=dummy.QUEUE_STATE_PATH)
+        json_lines_path = os.path.join(tmp, "metrics.jsonl")
+        prometheus_path = os.path.join(tmp, "metrics.prom")
+        results = qmr.map(
+            function=GOOD_FUNCTION,
+            jobs=GOOD_JOBS,
+            work_dir=os.path.join(tmp, "my_work_dir"),
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            metrics_json_lines_path=json_lines_path,
+            metrics_prometheus_textfile_path=prometheus_path,
+        )
+
+        assert len(results) == NUM_JOBS
+        with open(json_lines_path, "rt") as f:
+            records = [json.loads(line) for line in f.read().splitlines()]
+        assert len(records) > 1
+        assert records[-1]["num_finished"] == NUM_JOBS
+        assert records[-1]["bytes_written"] > 0
+        assert records[-1]["bytes_read"] > 0
+        assert os.path.exists(prometheus_path)
+
+
+def _has_at_least_ten_results(results_so_far):
+    return len([r for r in results_so_far if r is not None]) >= 10
+
+
+def test_metrics_count_jobs_in_bundles_and_bytes_read_while_waiting():
+    jobs = [numpy.arange(i, 100 + i) for i in range(30)]
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(path=dummy.QUEUE_STATE_PATH)
+        json_lines_path = os.path.join(tmp, "metrics.jsonl")
+        results = qmr.map(
+            function=GOOD_FUNCTION,
+            jobs=jobs,
+            work_dir=os.path.join(tmp, "my_work_dir"),
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            metrics_json_lines_path=json_lines_path,
+            num_jobs_per_batch_job=4,
+            stop_when=_has_at_least_ten_results,
+        )
+
+        with open(json_lines_path, "rt") as f:
+            records = [json.loads(line) for line in f.read().splitlines()]
+        assert records[0]["num_jobs"] == 30
+        assert records[0]["num_pending"] + records[0]["num_running"] == 30
+        assert any([r["bytes_read"] > 0 for r in records[:-1]])
+
+
+def test_return_stats():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(path=dummy.QUEUE_STATE_PATH)
+        results, stats = qmr.map(
+            function=GOOD_FUNCTION,
+            jobs=GOOD_JOBS,
+            work_dir=os.path.join(tmp, "my_work_dir"),
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            return_stats=True,
+        )
+
+        assert len(results) == NUM_JOBS
+        for phase in [
+            "writing_worker_node_script",
+            "pickling_jobs",
+            "writing_jobs",
+            "submitting",
+            "waiting",
+            "scanning_work_dir",
+            "reducing",
+            "removing_work_dir",
+        ]:
+            assert stats[phase]["wall_time_s"] >= 0.0
+        assert stats["pickling_jobs"]["count"] == NUM_JOBS
+        assert stats["writing_jobs"]["bytes"] > 0
+        assert stats["submitting"]["count"] == NUM_JOBS
+        assert stats["waiting"]["count"] > 0
+        assert stats["reducing"]["count"] == NUM_JOBS
+        assert stats["reducing"]["bytes"] > 0
+        assert "tree_reduce_submitting" not in stats
+
+
+def test_deduplicate_jobs():
+    jobs = []
+    for i in range(12):
+        jobs.append(numpy.arange(i % 3, 100 + i % 3))
+
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(path=dummy.QUEUE_STATE_PATH)
+        results, stats = qmr.map(
+            function=GOOD_FUNCTION,
+            jobs=jobs,
+            work_dir=os.path.join(tmp, "my_work_dir"),
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            deduplicate_jobs=True,
+            return_stats=True,
+        )
+
+        assert stats["submitting"]["count"] == 3
+        assert len(results) == 12
+        for i in range(12):
+            assert results[i] == GOOD_FUNCTION(jobs[i])
+
+        dummy.init_queue_state(path=dummy.QUEUE_STATE_PATH)
+        total = qmr.map(
+            function=GOOD_FUNCTION,
+            jobs=jobs,
+            work_dir=os.path.join(tmp, "my_work_dir_fold"),
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            deduplicate_jobs=True,
+            reducer=(0, operator.add),
+        )
+        assert total == sum([GOOD_FUNCTION(job) for job in jobs])
+
+
+def test_fold_results_reads_each_path_once():
+    read_paths = []
+
+    def read_results(paths):
+        for path in paths:
+            read_paths.append(path)
+            yield path.upper()
+
+    accumulator = qmr_tools._fold_results(
+        reducer=("", operator.add),
+        result_paths=["a", "b", None, "a", "c", "b"],
+        read_results=read_results,
+    )
+    assert accumulator == "ABACB"
+    assert read_paths == ["a", "b", "c"]
+
+
+def _has_at_least_three_results(results_so_far):
+    return len([r for r in results_so_far if r is not None]) >= 3
+
+
+def test_stop_when():
+    jobs = [numpy.arange(i, 100 + i) for i in range(30)]
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(path=dummy.QUEUE_STATE_PATH)
+        results = qmr.map(
+            function=GOOD_FUNCTION,
+            jobs=jobs,
+            work_dir=os.path.join(tmp, "my_work_dir"),
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            stop_when=_has_at_least_three_results,
+        )
+
+        assert len(results) == 30
+        num_landed = 0
+        for i in range(30):
+            if results[i] is not None:
+                num_landed += 1
+                assert results[i] == GOOD_FUNCTION(jobs[i])
+        assert 3 <= num_landed < 30
+        assert not os.path.exists(os.path.join(tmp, "my_work_dir"))
+
+        with open(dummy.QUEUE_STATE_PATH, "rt") as f:
+            state = json.loads(f.read())
+        assert len(state["running"]) == 0
+        assert len(state["pending"]) == 0
+
+
+def _has_at_least_one_result(results_so_far):
+    return len([r for r in results_so_far if r is not None]) >= 1
+
+
+def test_stop_when_returns_results_which_landed_after_last_qstat():
+    # The dummy qstat called by map() to delete the remaining jobs runs
+    # one more job.
+    jobs = [numpy.arange(i, 100 + i) for i in range(3)]
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        work_dir = os.path.join(tmp, "my_work_dir")
+        dummy.init_queue_state(path=dummy.QUEUE_STATE_PATH)
+        results = qmr.map(
+            function=GOOD_FUNCTION,
+            jobs=jobs,
+            work_dir=work_dir,
+            keep_work_dir=True,
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            stop_when=_has_at_least_one_result,
+        )
+
+        num_landed = 0
+        for i in range(3):
+            if os.path.exists(qmr_tools._job_path(work_dir, i) + ".out"):
+                num_landed += 1
+                assert results[i] == GOOD_FUNCTION(jobs[i])
+            else:
+                assert results[i] is None
+        assert num_landed == 2
+
+
+def test_stop_when_keeps_work_dir_when_jobs_are_left_in_queue():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        work_dir = os.path.join(tmp, "my_work_dir")
+        dummy.init_queue_state(
+            path=dummy.QUEUE_STATE_PATH, halted_queues=["halted"]
+        )
+        # This qdel does not delete anything.
+        lazy_qdel_path = os.path.join(tmp, "lazy_qdel.py")
+        with open(lazy_qdel_path, "wt") as f:
+            f.write("#!{:s}\nimport sys\nsys.exit(0)\n".format(sys.executable))
+        os.chmod(lazy_qdel_path, 0o755)
+
+        results = qmr.map(
+            function=GOOD_FUNCTION,
+            jobs=GOOD_JOBS,
+            queue_name=["fast", "halted"],
+            work_dir=work_dir,
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=lazy_qdel_path,
+            max_num_trials_qsub_qdel=2,
+            stop_when=_has_at_least_one_result,
+        )
+
+        assert len(results) == NUM_JOBS
+        assert len([r for r in results if r is not None]) >= 1
+        assert os.path.exists(work_dir)
+
+    dummy.init_queue_state(path=dummy.QUEUE_STATE_PATH)
+
+
+def test_remove_work_dir_in_background():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(path=dummy.QUEUE_STATE_PATH)
+        results = qmr.map(
+            function=GOOD_FUNCTION,
+            jobs=GOOD_JOBS,
+            work_dir=os.path.join(tmp, "my_work_dir"),
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            remove_work_dir_in_background=True,
+        )
+
+        assert len(results) == NUM_JOBS
+        assert not os.path.exists(os.path.join(tmp, "my_work_dir"))
+        trash_dir = os.path.join(tmp, ".qsub_trash")
+        assert os.path.isdir(trash_dir)
+        for i in range(100):
+            if len(os.listdir(trash_dir)) == 0:
+                break
+            time.sleep(0.1)
+        assert len(os.listdir(trash_dir)) == 0
+
+
+def test_bundles_of_jobs_in_parallel_environment():
+    bad_jobs = GOOD_JOBS.copy()
+    bad_jobs.append("np.sum will not work for me.")
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(path=dummy.QUEUE_STATE_PATH)
+        results = qmr.map(
+            function=GOOD_FUNCTION,
+            jobs=bad_jobs,
+            work_dir=os.path.join(tmp, "my_work_dir"),
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            job_num_slots=2,
+            parallel_environment="smp",
+            num_jobs_per_batch_job=4,
+        )
+
+        assert len(results) == NUM_JOBS + 1
+        for idx in range(NUM_JOBS):
+            assert results[idx] == GOOD_FUNCTION(GOOD_JOBS[idx])
+        assert results[NUM_JOBS] is None
+        work_dir = os.path.join(tmp, "my_work_dir")
+        assert os.path.exists(qmr_tools._bundle_path(work_dir, 2))
+        assert not os.path.exists(qmr_tools._bundle_path(work_dir, 3))
+
+
+def test_bundles_with_multiple_slots_require_parallel_environment():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        with pytest.raises(AssertionError):
+            qmr.map(
+                function=GOOD_FUNCTION,
+                jobs=GOOD_JOBS,
+                work_dir=os.path.join(tmp, "my_work_dir"),
+                qsub_path=dummy.QSUB_PATH,
+                qstat_path=dummy.QSTAT_PATH,
+                qdel_path=dummy.QDEL_PATH,
+                job_num_slots=2,
+                num_jobs_per_batch_job=4,
+            )
+        assert not os.path.exists(os.path.join(tmp, "my_work_dir"))
+
+
+def test_multiple_queues_move_pending_jobs_out_of_halted_queue():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(
+            path=dummy.QUEUE_STATE_PATH, halted_queues=["halted"]
+        )
+        results = qmr.map(
+            function=GOOD_FUNCTION,
+            jobs=GOOD_JOBS,
+            queue_name=["halted", "fast"],
+            work_dir=os.path.join(tmp, "my_work_dir"),
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            move_pending_jobs_between_queues=True,
+        )
+
+        assert len(results) == NUM_JOBS
+        for i in range(NUM_JOBS):
+            assert results[i] == GOOD_FUNCTION(GOOD_JOBS[i])
+
+
+def test_move_pending_jobs_resubmits_jobs_deleted_by_failed_qdel():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(
+            path=dummy.QUEUE_STATE_PATH, halted_queues=["halted"]
+        )
+        batch_jobs = []
+        for JB_name in ["stuck", "moved"]:
+            batch_jobs.append(
+                qmr_tools._make_batch_job(
+                    JB_name=JB_name,
+                    script_path=os.path.join(tmp, "script.py"),
+                    job_path=os.path.join(tmp, JB_name + ".pkl"),
+                )
+            )
+        balancer = queue_balancer.init(queue_names=["halted", "fast"])
+        for batch_job in batch_jobs:
+            queue_balancer._submitted(
+                balancer=balancer, batch_job=batch_job, queue_name="halted"
+            )
+        balancer["weights"] = {"halted": 0.1, "fast": 0.9}
+        failed = qmr_tools._qsub_batch_jobs(
+            batch_jobs=batch_jobs,
+            qsub_path=dummy.QSUB_PATH,
+            queue_name=None,
+            python_path=sys.executable,
+            num_threads=1,
+            max_num_trials=1,
+        )
+        assert len(failed) == 0
+        _, jobs_pending = qmr_tools._qstat(qstat_path=dummy.QSTAT_PATH)
+
+        # This qdel deletes all jobs but the stuck one, and fails.
+        stuck = [j for j in jobs_pending if j["JB_name"] == "stuck"][0]
+        stubborn_qdel_path = os.path.join(tmp, "stubborn_qdel.py")
+        with open(stubborn_qdel_path, "wt") as f:
+            f.write(
+                "#!{:s}\n"
+                "import subprocess, sys\n"
+                "args = [a for a in sys.argv[1:] if a != {:s}]\n"
+                "if args:\n"
+                "    subprocess.call([{:s}] + args)\n"
+                "sys.exit(1)\n".format(
+                    sys.executable,
+                    repr(stuck["JB_job_number"]),
+                    repr(dummy.QDEL_PATH),
+                )
+            )
+        os.chmod(stubborn_qdel_path, 0o755)
+
+        qmr_tools._move_pending_batch_jobs(
+            batch_jobs=batch_jobs,
+            jobs_pending=jobs_pending,
+            balancer=balancer,
+            qsub_path=dummy.QSUB_PATH,
+            qdel_path=stubborn_qdel_path,
+            qstat_path=dummy.QSTAT_PATH,
+            python_path=sys.executable,
+            qsub_num_threads=1,
+            max_num_trials_qsub_qdel=2,
+        )
+
+        with open(dummy.QUEUE_STATE_PATH, "rt") as f:
+            state = json.loads(f.read())
+        queue_name_by_JB_name = {}
+        for job in state["pending"]:
+            queue_name_by_JB_name[job["JB_name"]] = job["queue_name"]
+        assert queue_name_by_JB_name == {"stuck": "halted", "moved": "fast"}
+
+
+def test_pipeline():
+    bad_jobs = GOOD_JOBS.copy()
+    bad_jobs.append("np.cumsum will not work for me.")
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(path=dummy.QUEUE_STATE_PATH)
+        results = qmr.pipeline(
+            functions=[numpy.cumsum, numpy.sum],
+            jobs=bad_jobs,
+            work_dir=os.path.join(tmp, "my_work_dir"),
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+        )
+
+        assert len(results) == NUM_JOBS + 1
+        for i in range(NUM_JOBS):
+            assert results[i] == numpy.sum(numpy.cumsum(GOOD_JOBS[i]))
+        assert results[NUM_JOBS] is None
+
+        work_dir = os.path.join(tmp, "my_work_dir")
+        stage_00 = qmr_tools._stage_dir(work_dir, 0)
+        stage_01 = qmr_tools._stage_dir(work_dir, 1)
+        assert os.path.exists(qmr_tools._job_path(stage_00, 0) + ".out")
+        assert not os.path.exists(qmr_tools._job_path(stage_01, 0))
+        assert os.path.exists(qmr_tools._job_path(stage_01, 0) + ".out")
+        assert not os.path.exists(
+            qmr_tools._job_path(stage_01, NUM_JOBS) + ".e"
+        )
+
+
+def test_next_stage_batch_jobs_only_for_jobs_with_result():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        work_dir = os.path.join(tmp, "my_work_dir")
+        os.makedirs(qmr_tools._stage_dir(work_dir, 0))
+        finished = []
+        for idx in range(3):
+            finished.append(
+                qmr_tools._make_stage_batch_job(
+                    work_dir=work_dir, session_id="abc", stage=0, idx=idx
+                )
+            )
+        for idx in [0, 2]:
+            path = qmr_tools._job_path(qmr_tools._stage_dir(work_dir, 0), idx)
+            with open(path + ".out", "wb") as f:
+                f.write(pickle.dumps(idx))
+
+        next_batch_jobs = qmr_tools._next_stage_batch_jobs(
+            finished_batch_jobs=finished,
+            work_dir=work_dir,
+            session_id="abc",
+            num_stages=2,
+        )
+        assert [bj["idxs"] for bj in next_batch_jobs] == [[0], [2]]
+        assert [bj["stage"] for bj in next_batch_jobs] == [1, 1]
+
+
+def test_memory_map_results():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        dummy.init_queue_state(path=dummy.QUEUE_STATE_PATH)
+        results = qmr.map(
+            function=numpy.cumsum,
+            jobs=GOOD_JOBS,
+            work_dir=os.path.join(tmp, "my_work_dir"),
+            polling_interval_qstat=1e-3,
+            qsub_path=dummy.QSUB_PATH,
+            qstat_path=dummy.QSTAT_PATH,
+            qdel_path=dummy.QDEL_PATH,
+            memory_map_results=True,
+        )
+
+        assert len(results) == NUM_JOBS
+        for i in range(NUM_JOBS):
+            assert isinstance(results[i], numpy.memmap)
+            numpy.testing.assert_array_equal(
+                results[i], numpy.cumsum(GOOD_JOBS[i])
+            )
+        assert os.path.exists(os.path.join(tmp, "my_work_dir"))
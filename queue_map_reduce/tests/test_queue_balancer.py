@@ -0,0 +1,108 @@
+from queue_map_reduce import queue_balancer
+
+
+def _batch_jobs(num):
+    return [{"JB_name": "q#{:09d}".format(i)} for i in range(num)]
+
+
+def test_assign_follows_weights():
+    b = queue_balancer.init(queue_names=["a", "b"])
+    batch_jobs = _batch_jobs(10)
+    queue_balancer.assign(balancer=b, batch_jobs=batch_jobs)
+    queue_names = [bj["queue_name"] for bj in batch_jobs]
+    assert queue_names.count("a") == 5
+    assert queue_names.count("b") == 5
+
+    b["weights"] = {"a": 0.8, "b": 0.2}
+    batch_jobs = _batch_jobs(10)
+    queue_balancer.assign(balancer=b, batch_jobs=batch_jobs)
+    queue_names = [bj["queue_name"] for bj in batch_jobs]
+    assert queue_names.count("a") == 8
+    assert queue_names.count("b") == 2
+
+
+def test_weights_shift_toward_faster_queue():
+    b = queue_balancer.init(queue_names=["slow", "fast"])
+    batch_jobs = _batch_jobs(8)
+    queue_balancer.assign(balancer=b, batch_jobs=batch_jobs)
+    slow = [bj["JB_name"] for bj in batch_jobs if bj["queue_name"] == "slow"]
+    fast = [bj["JB_name"] for bj in batch_jobs if bj["queue_name"] == "fast"]
+
+    queue_balancer.update(
+        balancer=b,
+        JB_names_running=set(fast[0:2]),
+        JB_names_pending=set(slow + fast[2:]),
+        JB_names_error=set(),
+    )
+    assert b["num_started"] == {"slow": 0, "fast": 2}
+    assert b["num_finished"] == {"slow": 0, "fast": 0}
+    assert b["weights"]["fast"] > b["weights"]["slow"]
+    assert queue_balancer.fastest_queue_name(b) == "fast"
+
+    queue_balancer.update(
+        balancer=b,
+        JB_names_running=set(),
+        JB_names_pending=set(slow),
+        JB_names_error=set(),
+    )
+    assert b["num_started"] == {"slow": 0, "fast": 4}
+    assert b["num_finished"] == {"slow": 0, "fast": 4}
+    assert abs(sum(b["weights"].values()) - 1.0) < 1e-9
+
+    to_move = queue_balancer.JB_names_to_move(
+        balancer=b, JB_names_pending=set(slow)
+    )
+    assert to_move == sorted(slow)
+
+    moved = [bj for bj in batch_jobs if bj["JB_name"] in to_move]
+    queue_balancer.move(balancer=b, batch_jobs=moved)
+    for bj in moved:
+        assert bj["queue_name"] == "fast"
+    assert (
+        queue_balancer.JB_names_to_move(
+            balancer=b, JB_names_pending=set(slow)
+        )
+        == []
+    )
+
+
+def test_unused_queue_gets_mean_progress():
+    b = queue_balancer.init(queue_names=["a", "b", "c"])
+    batch_jobs = _batch_jobs(2)
+    queue_balancer.assign(balancer=b, batch_jobs=batch_jobs)
+    assert b["num_submitted"] == {"a": 1, "b": 1, "c": 0}
+
+    queue_balancer.update(
+        balancer=b,
+        JB_names_running=set(),
+        JB_names_pending=set(bj["JB_name"] for bj in batch_jobs),
+        JB_names_error=set(),
+    )
+    assert abs(b["weights"]["a"] - 1.0 / 3.0) < 1e-9
+    assert abs(b["weights"]["b"] - 1.0 / 3.0) < 1e-9
+    assert abs(b["weights"]["c"] - 1.0 / 3.0) < 1e-9
+    to_move = queue_balancer.JB_names_to_move(
+        balancer=b, JB_names_pending=set(bj["JB_name"] for bj in batch_jobs)
+    )
+    assert to_move == []
+
+
+def test_nothing_is_moved_before_a_job_started():
+    b = queue_balancer.init(queue_names=["a", "b"])
+    batch_jobs = _batch_jobs(3)
+    for batch_job in batch_jobs:
+        queue_balancer._submitted(
+            balancer=b, batch_job=batch_job, queue_name="a"
+        )
+    queue_balancer.update(
+        balancer=b,
+        JB_names_running=set(),
+        JB_names_pending=set(bj["JB_name"] for bj in batch_jobs),
+        JB_names_error=set(),
+    )
+    assert queue_balancer.fastest_queue_name(b) == "a"
+    b["weights"] = {"a": 0.1, "b": 0.9}
+    to_move = queue_balancer.JB_names_to_move(
+        balancer=b, JB_names_pending=set(bj["JB_name"] for bj in batch_jobs)
+    )
+    assert to_move == []
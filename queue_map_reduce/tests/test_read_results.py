@@ -0,0 +1,33 @@
+from queue_map_reduce import tools as qmr_tools
+import pickle
+import tempfile
+import os
+
+
+def test_read_results_keeps_order():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        result_paths = []
+        for idx in range(25):
+            if idx % 7 == 3:
+                result_paths.append(None)
+                continue
+            path = os.path.join(tmp, "{:09d}.pkl.out".format(idx))
+            with open(path, "wb") as f:
+                f.write(pickle.dumps({"idx": idx}))
+            result_paths.append(path)
+
+        setups = [(1, "thread"), (4, "thread"), (3, "process")]
+        for num_workers, pool in setups:
+            results = list(
+                qmr_tools._read_results(
+                    result_paths=result_paths,
+                    num_workers=num_workers,
+                    pool=pool,
+                )
+            )
+            assert len(results) == 25
+            for idx in range(25):
+                if idx % 7 == 3:
+                    assert results[idx] is None
+                else:
+                    assert results[idx] == {"idx": idx}
@@ -0,0 +1,72 @@
+from queue_map_reduce import tools as qmr_tools
+import tempfile
+import time
+import os
+
+
+def _touch(path, size=0):
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+
+
+def _wait_until(condition, timeout_s=10.0):
+    start = time.time()
+    while not condition():
+        if time.time() - start > timeout_s:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_remove_work_dir_in_background():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        work_dir = os.path.join(tmp, "work_dir")
+        os.makedirs(os.path.join(work_dir, "sub"))
+        _touch(os.path.join(work_dir, "sub", "000000000.pkl.out"), 3)
+
+        trash_dir = qmr_tools._trash_dir(work_dir)
+        leftover = os.path.join(trash_dir, "leftover")
+        os.makedirs(leftover)
+
+        trash_path = qmr_tools._move_to_trash_and_remove_in_background(
+            work_dir=work_dir
+        )
+        assert not os.path.exists(work_dir)
+        assert _wait_until(lambda: not os.path.exists(trash_path))
+        assert os.listdir(trash_dir) == ["leftover"]
+
+        qmr_tools._sweep_trash(work_dir=work_dir)
+        assert _wait_until(lambda: os.listdir(trash_dir) == [])
+
+
+def test_sweep_trash_skips_claimed_entries_until_they_are_stale():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        work_dir = os.path.join(tmp, "work_dir")
+        trash_dir = qmr_tools._trash_dir(work_dir)
+        suffix = qmr_tools._TRASH_CLAIM_SUFFIX
+        claimed = os.path.join(trash_dir, "busy" + suffix)
+        os.makedirs(claimed)
+        stale = os.path.join(trash_dir, "dead" + suffix)
+        os.makedirs(stale)
+        long_ago = time.time() - 2 * qmr_tools._TRASH_CLAIM_TIMEOUT_S
+        os.utime(stale, (long_ago, long_ago))
+
+        qmr_tools._sweep_trash(work_dir=work_dir)
+        assert _wait_until(
+            lambda: os.listdir(trash_dir) == [os.path.basename(claimed)]
+        )
+
+
+def test_remove_in_background_leaves_no_child_process():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        path = os.path.join(tmp, "to_be_removed")
+        os.makedirs(path)
+        qmr_tools._remove_in_background(path=path)
+        assert _wait_until(lambda: not os.path.exists(path))
+        # The removal is not our child, so there is nothing to wait for.
+        try:
+            os.waitpid(-1, os.WNOHANG)
+            has_child = True
+        except ChildProcessError:
+            has_child = False
+        assert not has_child
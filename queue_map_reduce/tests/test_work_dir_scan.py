@@ -0,0 +1,56 @@
+from queue_map_reduce import tools as qmr_tools
+import tempfile
+import os
+
+
+def _touch(path, size=0):
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+
+
+def test_scan_work_dir():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        _touch(os.path.join(tmp, "000000000.pkl"), 10)
+        _touch(os.path.join(tmp, "000000000.pkl.out"), 3)
+        _touch(os.path.join(tmp, "000000000.pkl.e"), 0)
+        _touch(os.path.join(tmp, "000000001.pkl.e"), 7)
+        _touch(os.path.join(tmp, "000000001.pkl.out.1234.tmp"), 5)
+
+        sizes = qmr_tools._scan_work_dir(work_dir=tmp)
+        assert sizes == {
+            "000000000.pkl.out": 3,
+            "000000000.pkl.e": 0,
+            "000000001.pkl.e": 7,
+        }
+
+
+def test_job_status_table():
+    sizes = {
+        "000000000.pkl.out": 3,
+        "000000000.pkl.e": 0,
+        "000000001.pkl.e": 7,
+    }
+    table = qmr_tools._job_status_table(
+        work_dir_sizes=sizes, idxs=range(3)
+    )
+    assert len(table) == 3
+    assert table[0] == {"idx": 0, "result_size": 3, "stderr_size": 0}
+    assert table[1] == {"idx": 1, "result_size": None, "stderr_size": 7}
+    assert table[2] == {"idx": 2, "result_size": None, "stderr_size": None}
+
+    assert qmr_tools._has_invalid_or_non_empty_stderr(table)
+    assert not qmr_tools._has_invalid_or_non_empty_stderr(table[0:1])
+    assert qmr_tools._has_invalid_or_non_empty_stderr(table[2:3])
+
+
+def test_job_status_table_counts_npy_files_of_result():
+    sizes = {
+        "000000000.pkl.out": 3,
+        "000000000.pkl.out.0.npy": 100,
+        "000000000.pkl.out.1.npy": 20,
+        "000000000.pkl.e": 0,
+        "000000001.pkl.out.0.npy": 100,
+    }
+    table = qmr_tools._job_status_table(work_dir_sizes=sizes, idxs=range(2))
+    assert table[0]["result_size"] == 123
+    assert table[1]["result_size"] is None
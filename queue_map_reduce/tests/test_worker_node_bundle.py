@@ -0,0 +1,83 @@
+from queue_map_reduce import worker_node_bundle
+from queue_map_reduce import npy_results
+import pickle
+import numpy
+import tempfile
+import json
+import os
+
+
+def _write_bundle(tmp, jobs):
+    job_paths = []
+    for idx, job in enumerate(jobs):
+        job_path = os.path.join(tmp, "{:09d}.pkl".format(idx))
+        with open(job_path, "wb") as f:
+            f.write(pickle.dumps(job))
+        job_paths.append(job_path)
+    bundle_path = os.path.join(tmp, "bundle_000000000.json")
+    with open(bundle_path, "wt") as f:
+        f.write(json.dumps(job_paths))
+    return bundle_path, job_paths
+
+
+def test_run_bundle_with_pool():
+    jobs = [numpy.arange(i, i + 100) for i in range(5)]
+    jobs.append("numpy.sum will not work for me.")
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        bundle_path, job_paths = _write_bundle(tmp=tmp, jobs=jobs)
+        worker_node_bundle.run(
+            function=numpy.sum,
+            bundle_path=bundle_path,
+            num_processes=2,
+            measure_usage=True,
+        )
+
+        for idx in range(5):
+            with open(job_paths[idx] + ".out", "rb") as f:
+                assert pickle.loads(f.read()) == numpy.sum(jobs[idx])
+            assert os.stat(job_paths[idx] + ".e").st_size == 0
+        assert not os.path.exists(job_paths[5] + ".out")
+        assert os.stat(job_paths[5] + ".e").st_size > 0
+
+        with open(bundle_path + ".usage", "rt") as f:
+            usage = json.loads(f.read())
+        assert usage["peak_memory_bytes"] > 0
+
+
+def test_run_bundle_skips_jobs_with_result():
+    jobs = [numpy.arange(i, i + 100) for i in range(3)]
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        bundle_path, job_paths = _write_bundle(tmp=tmp, jobs=jobs)
+        with open(job_paths[1] + ".out", "wb") as f:
+            f.write(pickle.dumps("landed before"))
+
+        worker_node_bundle.run(
+            function=numpy.sum, bundle_path=bundle_path, num_processes=2,
+        )
+
+        with open(job_paths[1] + ".out", "rb") as f:
+            assert pickle.loads(f.read()) == "landed before"
+        assert not os.path.exists(job_paths[1] + ".e")
+        with open(job_paths[2] + ".out", "rb") as f:
+            assert pickle.loads(f.read()) == numpy.sum(jobs[2])
+
+
+def test_run_bundle_stages_npy_results():
+    jobs = [numpy.arange(i, i + 100) for i in range(3)]
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        bundle_path, job_paths = _write_bundle(tmp=tmp, jobs=jobs)
+        worker_node_tmp_dir = os.path.join(tmp, "worker_node_tmp_dir")
+        os.makedirs(worker_node_tmp_dir)
+        worker_node_bundle.run(
+            function=numpy.cumsum,
+            bundle_path=bundle_path,
+            num_processes=2,
+            worker_node_tmp_dir=worker_node_tmp_dir,
+            npy_results=True,
+        )
+
+        assert os.listdir(worker_node_tmp_dir) == []
+        for idx in range(3):
+            result = npy_results.read(job_paths[idx] + ".out")
+            assert isinstance(result, numpy.memmap)
+            numpy.testing.assert_array_equal(result, numpy.cumsum(jobs[idx]))
@@ -0,0 +1,33 @@
+from queue_map_reduce import worker_node_cache
+import tempfile
+import os
+
+
+def test_local_path_without_cache_dir():
+    os.environ.pop(worker_node_cache.CACHE_DIR_KEY, None)
+    assert worker_node_cache.local_path("/a/b/c.txt") == "/a/b/c.txt"
+
+
+def test_local_path_copies_only_once():
+    with tempfile.TemporaryDirectory(prefix="sge") as tmp:
+        cache_dir = os.path.join(tmp, "cache")
+        input_path = os.path.join(tmp, "input.txt")
+        with open(input_path, "wt") as f:
+            f.write("lookup-table")
+
+        os.environ[worker_node_cache.CACHE_DIR_KEY] = cache_dir
+        try:
+            path = worker_node_cache.local_path(input_path)
+            assert path != input_path
+            assert path.startswith(cache_dir)
+            assert os.path.basename(path) == "input.txt"
+            with open(path, "rt") as f:
+                assert f.read() == "lookup-table"
+
+            mtime_ns = os.stat(path).st_mtime_ns
+            path_again = worker_node_cache.local_path(input_path)
+            assert path_again == path
+            assert os.stat(path_again).st_mtime_ns == mtime_ns
+            assert len(os.listdir(cache_dir)) == 1
+        finally:
+            os.environ.pop(worker_node_cache.CACHE_DIR_KEY)
@@ -6,10 +6,30 @@ import qstat
 import time
 import shutil
 import json
+import collections
+import concurrent.futures
+import functools
+import math
+import hashlib
+import sys
+import uuid
 from . import network_file_system as nfs
-
-
-def _make_worker_node_script(module_name, function_name, environ):
+from . import worker_node_cache
+from . import metrics
+from . import queue_balancer
+from . import npy_results
+
+
+def _make_worker_node_script(
+    module_name,
+    function_name,
+    environ,
+    shared_path=None,
+    stage=False,
+    measure_usage=False,
+    job_input_dir=None,
+    npy_results=False,
+):
     """
     Returns a string that is a python-script.
     This python-script will be executed on the worker-node.
@@ -19,6 +39,29 @@ def _make_worker_node_script(module_name, function_name, environ):
 
     python script.py /some/path/to/work_dir/{idx:09d}.pkl
 
+    When shared_path is given, the shared payload is read from there once,
+    using a memory-map to avoid an extra copy of the file's content, and
+    the script runs result = function(job, shared) instead.
+
+    When stage is True, and the worker-node has a local TMPDIR, the job is
+    copied into the TMPDIR and the result is written there first. Finally,
+    the result is moved back into the work_dir in a single step, and the
+    copy of the job is removed from the TMPDIR.
+
+    When measure_usage is True, the script writes its peak resident memory
+    and its wall-time to /some/path/to/work_dir/{idx:09d}.pkl.usage after
+    it wrote the result.
+
+    When job_input_dir is given, the job is not read from the path in the
+    argument, but from the result with the same filename in job_input_dir,
+    i.e. /some/path/to/job_input_dir/{idx:09d}.pkl.out. This chains the
+    stages of a pipeline without a round-trip through the process-node.
+
+    When npy_results is True, the result is written using
+    queue_map_reduce.npy_results.write(). Arrays are written in numpy's
+    .npy-format. When stage is True, they are moved into the work_dir using
+    queue_map_reduce.npy_results.move().
+
     On environment-variables
     ------------------------
     There is the '-V' option in qsub which is meant to export ALL environment-
@@ -29,13 +72,230 @@ def _make_worker_node_script(module_name, function_name, environ):
     This is why we set the einvironment-variables here in the
     worker-node-script.
     """
-    add_environ = ""
-    for key in environ:
-        add_environ += 'os.environ["{key:s}"] = "{value:s}"\n'.format(
-            key=key.encode("unicode_escape").decode(),
-            value=environ[key].encode("unicode_escape").decode(),
+    return (
+        ""
+        "# I was generated automatically by queue_map_reduce.\n"
+        "# I will be executed on the worker-nodes.\n"
+        "# Do not modify me.\n"
+        "from {module_name:s} import {function_name:s}\n"
+        "import pickle\n"
+        "import sys\n"
+        "import os\n"
+        "from queue_map_reduce import network_file_system as nfs\n"
+        "{start_usage:s}"
+        "{read_worker_node_tmp_dir:s}"
+        "\n"
+        "{add_environ:s}"
+        "\n"
+        "assert(len(sys.argv) == 2)\n"
+        "{read_job:s}"
+        "{read_shared:s}"
+        "\n"
+        "result = {function_name:s}(job{shared_argument:s})\n"
+        "\n"
+        "{write_result:s}"
+        "{write_usage:s}"
+        "".format(
+            module_name=module_name,
+            function_name=function_name,
+            start_usage=(
+                "import resource\nimport json\nimport time\n"
+                "start_time = time.time()\n"
+                if measure_usage
+                else ""
+            ),
+            write_usage=_make_write_usage_str(measure_usage=measure_usage),
+            read_worker_node_tmp_dir=(
+                '\nworker_node_tmp_dir = os.environ.get("TMPDIR", "")\n'
+                if stage
+                else ""
+            ),
+            add_environ=_make_add_environ_str(environ=environ),
+            read_job=_make_read_job_str(
+                stage=stage, job_input_dir=job_input_dir
+            ),
+            write_result=_make_write_result_str(
+                stage=stage, npy_results=npy_results
+            ),
+            read_shared=_make_read_shared_str(shared_path=shared_path),
+            shared_argument="" if shared_path is None else ", shared",
+        )
+    )
+
+
+def _make_read_job_str(stage, job_input_dir=None):
+    if job_input_dir is None:
+        source = "sys.argv[1]"
+        read_job_input_path = ""
+    else:
+        source = "job_input_path"
+        read_job_input_path = (
+            ""
+            "job_input_path = os.path.join(\n"
+            "    {job_input_dir:s}, os.path.basename(sys.argv[1]) + '.out'\n"
+            ")\n"
+            "".format(job_input_dir=repr(job_input_dir))
+        )
+    if not stage:
+        return read_job_input_path + (
+            'job = pickle.loads(nfs.read({source:s}, mode="rb"))\n'.format(
+                source=source
+            )
+        )
+    return read_job_input_path + (
+        ""
+        "if worker_node_tmp_dir:\n"
+        "    job_path = os.path.join(\n"
+        "        worker_node_tmp_dir, os.path.basename(sys.argv[1])\n"
+        "    )\n"
+        "    nfs.copy({source:s}, job_path)\n"
+        "else:\n"
+        "    job_path = {source:s}\n"
+        'job = pickle.loads(nfs.read(job_path, mode="rb"))\n'
+        "".format(source=source)
+    )
+
+
+def _make_write_result_str(stage, npy_results=False):
+    if npy_results and not stage:
+        return (
+            ""
+            "from queue_map_reduce import npy_results\n"
+            'npy_results.write(result, sys.argv[1]+".out")\n'
+        )
+    if npy_results:
+        return (
+            ""
+            "from queue_map_reduce import npy_results\n"
+            "if worker_node_tmp_dir:\n"
+            '    npy_results.write(result, job_path+".out")\n'
+            '    npy_results.move(job_path+".out", sys.argv[1]+".out")\n'
+            "    os.remove(job_path)\n"
+            "else:\n"
+            '    npy_results.write(result, sys.argv[1]+".out")\n'
+        )
+    if not stage:
+        return (
+            'nfs.write(pickle.dumps(result), sys.argv[1]+".out", mode="wb")\n'
+        )
+    return (
+        ""
+        "if worker_node_tmp_dir:\n"
+        '    with open(job_path+".out", "wb") as f:\n'
+        "        f.write(pickle.dumps(result))\n"
+        '    nfs.move(job_path+".out", sys.argv[1]+".out")\n'
+        "    os.remove(job_path)\n"
+        "else:\n"
+        '    nfs.write(pickle.dumps(result), sys.argv[1]+".out", mode="wb")\n'
+    )
+
+
+def _make_write_usage_str(measure_usage):
+    if not measure_usage:
+        return ""
+    return (
+        ""
+        "\n"
+        "usage = {\n"
+        '    "peak_memory_bytes": 1024 * resource.getrusage(\n'
+        "        resource.RUSAGE_SELF\n"
+        "    ).ru_maxrss,\n"
+        '    "wall_time_s": time.time() - start_time,\n'
+        "}\n"
+        'nfs.write(json.dumps(usage), sys.argv[1]+".usage", mode="wt")\n'
+    )
+
+
+def _make_read_shared_str(shared_path):
+    if shared_path is None:
+        return ""
+    return (
+        ""
+        "\n"
+        "import mmap\n"
+        "with open({shared_path:s}, mode='rb') as f:\n"
+        "    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:\n"
+        "        shared = pickle.loads(m)\n"
+        "".format(shared_path=repr(shared_path))
+    )
+
+
+def _make_bundle_worker_node_script(
+    module_name,
+    function_name,
+    environ,
+    num_processes,
+    shared_path=None,
+    stage=False,
+    measure_usage=False,
+    npy_results=False,
+):
+    """
+    Returns a string that is a python-script.
+    This python-script will be executed on the worker-node to process a
+    bundle of jobs using a pool of num_processes. Just like the
+    worker-node-script, it sets the environment-variables explicitly.
+    The jobs are processed by queue_map_reduce.worker_node_bundle.run().
+    The script will be called on the worker-node with a single argument:
+
+    python script.py /some/path/to/work_dir/bundle_{idx:09d}.json
+
+    When measure_usage is True, the script writes the peak resident memory
+    of its largest process and its wall-time to
+    /some/path/to/work_dir/bundle_{idx:09d}.json.usage.
+    """
+    return (
+        ""
+        "# I was generated automatically by queue_map_reduce.\n"
+        "# I will be executed on the worker-nodes.\n"
+        "# Do not modify me.\n"
+        "from {module_name:s} import {function_name:s}\n"
+        "import sys\n"
+        "import os\n"
+        "from queue_map_reduce import worker_node_bundle\n"
+        "\n"
+        'worker_node_tmp_dir = os.environ.get("TMPDIR", "")\n'
+        "\n"
+        "{add_environ:s}"
+        "\n"
+        'if __name__ == "__main__":\n'
+        "    assert(len(sys.argv) == 2)\n"
+        "    worker_node_bundle.run(\n"
+        "        function={function_name:s},\n"
+        "        bundle_path=sys.argv[1],\n"
+        "        num_processes={num_processes:d},\n"
+        "        shared_path={shared_path:s},\n"
+        "        worker_node_tmp_dir={worker_node_tmp_dir:s},\n"
+        "        measure_usage={measure_usage:s},\n"
+        "        npy_results={npy_results:s},\n"
+        "    )\n"
+        "".format(
+            module_name=module_name,
+            function_name=function_name,
+            add_environ=_make_add_environ_str(environ=environ),
+            num_processes=num_processes,
+            shared_path=repr(shared_path),
+            worker_node_tmp_dir="worker_node_tmp_dir" if stage else "None",
+            measure_usage=repr(bool(measure_usage)),
+            npy_results=repr(bool(npy_results)),
         )
+    )
+
 
+def _make_reduce_node_script(module_name, function_name, environ):
+    """
+    Returns a string that is a python-script.
+    This python-script will be executed on the worker-node to reduce a group
+    of results. Just like the worker-node-script, it sets the
+    environment-variables explicitly.
+    It reads the reduce-job which contains the initial accumulator and the
+    paths of the results to be reduced. It folds each result into the
+    accumulator using accumulator = function(accumulator, result), and writes
+    the accumulator. The script will be called on the worker-node with a
+    single argument:
+
+    python script.py /some/path/to/work_dir/reduce_{level:02d}/{idx:09d}.pkl
+    """
     return (
         ""
         "# I was generated automatically by queue_map_reduce.\n"
@@ -50,19 +310,32 @@ def _make_worker_node_script(module_name, function_name, environ):
         "{add_environ:s}"
         "\n"
         "assert(len(sys.argv) == 2)\n"
-        'job = pickle.loads(nfs.read(sys.argv[1], mode="rb"))\n'
+        'reduce_job = pickle.loads(nfs.read(sys.argv[1], mode="rb"))\n'
         "\n"
-        "result = {function_name:s}(job)\n"
+        'accumulator = reduce_job["initial"]\n'
+        'for path in reduce_job["paths"]:\n'
+        '    result = pickle.loads(nfs.read(path, mode="rb"))\n'
+        "    accumulator = {function_name:s}(accumulator, result)\n"
         "\n"
-        'nfs.write(pickle.dumps(result), sys.argv[1]+".out", mode="wb")\n'
+        'nfs.write(pickle.dumps(accumulator), sys.argv[1]+".out", mode="wb")\n'
         "".format(
             module_name=module_name,
             function_name=function_name,
-            add_environ=add_environ,
+            add_environ=_make_add_environ_str(environ=environ),
         )
     )
 
 
+def _make_add_environ_str(environ):
+    add_environ = ""
+    for key in environ:
+        add_environ += 'os.environ["{key:s}"] = "{value:s}"\n'.format(
+            key=key.encode("unicode_escape").decode(),
+            value=environ[key].encode("unicode_escape").decode(),
+        )
+    return add_environ
+
+
 def _qsub(
     qsub_path,
     queue_name,
@@ -72,10 +345,13 @@ def _qsub(
     JB_name,
     stdout_path,
     stderr_path,
+    resources=None,
 ):
     cmd = [qsub_path]
     if queue_name:
         cmd += ["-q", queue_name]
+    if resources:
+        cmd += _make_resources_arguments(resources=resources)
     cmd += ["-o", stdout_path]
     cmd += ["-e", stderr_path]
     cmd += ["-N", JB_name]
@@ -92,8 +368,195 @@ def _qsub(
         raise
 
 
+def _make_resources_arguments(resources):
+    """
+    Returns the arguments for qsub to request the resources.
+    The hard limits for virtual memory 'h_vmem' in bytes, and for wall-time
+    'h_rt' in seconds are requested with '-l'. The 'slots' in a parallel
+    environment 'pe' are requested with '-pe'.
+    """
+    arguments = []
+    hard_resource_list = []
+    for key in ["h_vmem", "h_rt"]:
+        if resources.get(key, None) is not None:
+            hard_resource_list.append(
+                "{:s}={:d}".format(key, int(resources[key]))
+            )
+    if hard_resource_list:
+        arguments += ["-l", ",".join(hard_resource_list)]
+    if resources.get("pe", None) is not None:
+        arguments += ["-pe", resources["pe"], str(resources["slots"])]
+    return arguments
+
+
+def _make_resources(memory_bytes, runtime_s, num_slots, parallel_environment):
+    return {
+        "h_vmem": memory_bytes,
+        "h_rt": runtime_s,
+        "pe": parallel_environment,
+        "slots": num_slots,
+    }
+
+
+def _escalate_resources(resources, factor, usage_summary):
+    """
+    Returns the resources for a batch-job which is resubmitted.
+    Memory and wall-time are increased by factor. They are at least
+    the largest peak-memory, and wall-time observed in the completed jobs so
+    far, plus a margin of 25%.
+    """
+    escalated = dict(resources)
+    for key, usage_key in [
+        ("h_vmem", "max_peak_memory_bytes"),
+        ("h_rt", "max_wall_time_s"),
+    ]:
+        if escalated.get(key, None) is None:
+            continue
+        value = escalated[key] * factor
+        if usage_summary["num"] > 0:
+            value = max(value, 1.25 * usage_summary[usage_key])
+        escalated[key] = int(math.ceil(value))
+    return escalated
+
+
+def _init_usage_summary():
+    return {"num": 0, "max_peak_memory_bytes": 0, "max_wall_time_s": 0.0}
+
+
+def _update_usage_summary(usage_summary, usage_dir, read_usage_filenames):
+    """
+    Reads the usages of the jobs which completed since the last update
+    and adds them to the usage_summary. The usage_dir is listed once to
+    find them.
+    """
+    sizes = _scan_work_dir(work_dir=usage_dir, suffixes=(".usage",))
+    for filename in sizes:
+        if filename in read_usage_filenames:
+            continue
+        read_usage_filenames.add(filename)
+        usage = json.loads(
+            nfs.read(path=os.path.join(usage_dir, filename), mode="rt")
+        )
+        usage_summary["num"] += 1
+        usage_summary["max_peak_memory_bytes"] = max(
+            usage_summary["max_peak_memory_bytes"], usage["peak_memory_bytes"]
+        )
+        usage_summary["max_wall_time_s"] = max(
+            usage_summary["max_wall_time_s"], usage["wall_time_s"]
+        )
+
+
+def _make_batch_job(
+    JB_name, script_path, job_path, resources=None, idxs=None
+):
+    """
+    The idxs are the jobs processed by this batch-job. This is the single
+    job in job_path, or all jobs in the bundle in job_path.
+    """
+    return {
+        "JB_name": JB_name,
+        "script_path": script_path,
+        "arguments": [job_path],
+        "stdout_path": job_path + ".o",
+        "stderr_path": job_path + ".e",
+        "resources": resources,
+        "idxs": idxs,
+    }
+
+
+def _num_jobs_in_batch_job(batch_job):
+    if batch_job["idxs"] is None:
+        return 1
+    return len(batch_job["idxs"])
+
+
+def _qsub_batch_job(batch_job, qsub_path, queue_name, python_path):
+    """
+    A batch-job assigned to one of multiple queues has its own queue_name.
+    """
+    _qsub(
+        qsub_path=qsub_path,
+        queue_name=batch_job.get("queue_name", queue_name),
+        script_exe_path=python_path,
+        script_path=batch_job["script_path"],
+        arguments=batch_job["arguments"],
+        JB_name=batch_job["JB_name"],
+        stdout_path=batch_job["stdout_path"],
+        stderr_path=batch_job["stderr_path"],
+        resources=batch_job["resources"],
+    )
+
+
+def _try_qsub_batch_job(
+    batch_job, qsub_path, queue_name, python_path, max_num_trials
+):
+    """
+    Submits the batch-job.
+    Try again in case of Failure, but only max_num_trials times.
+    Only except KeyboardInterrupt to stop.
+    Returns True when qsub succeeded.
+    """
+    for trial in range(max_num_trials):
+        try:
+            _qsub_batch_job(
+                batch_job=batch_job,
+                qsub_path=qsub_path,
+                queue_name=queue_name,
+                python_path=python_path,
+            )
+            return True
+        except KeyboardInterrupt:
+            raise
+        except Exception as bad:
+            _log("Problem in qsub ", batch_job["JB_name"])
+            print(bad)
+            time.sleep(1)
+    return False
+
+
+def _qsub_batch_jobs(
+    batch_jobs, qsub_path, queue_name, python_path, num_threads, max_num_trials
+):
+    """
+    Submits the batch-jobs using num_threads calls of qsub in parallel.
+    Returns the batch-jobs which could not be submitted.
+    """
+    try_qsub = functools.partial(
+        _try_qsub_batch_job,
+        qsub_path=qsub_path,
+        queue_name=queue_name,
+        python_path=python_path,
+        max_num_trials=max_num_trials,
+    )
+    if num_threads <= 1:
+        submitted = [try_qsub(batch_job) for batch_job in batch_jobs]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+            submitted = list(executor.map(try_qsub, batch_jobs))
+
+    failed_batch_jobs = []
+    for batch_job, is_submitted in zip(batch_jobs, submitted):
+        if not is_submitted:
+            failed_batch_jobs.append(batch_job)
+    return failed_batch_jobs
+
+
+def _job_filename(idx):
+    return "{:09d}.pkl".format(idx)
+
+
 def _job_path(work_dir, idx):
-    return os.path.abspath(os.path.join(work_dir, "{:09d}.pkl".format(idx)))
+    return os.path.abspath(os.path.join(work_dir, _job_filename(idx)))
+
+
+def _bundle_filename(bundle_idx):
+    return "bundle_{:09d}.json".format(bundle_idx)
+
+
+def _bundle_path(work_dir, bundle_idx):
+    return os.path.abspath(
+        os.path.join(work_dir, _bundle_filename(bundle_idx))
+    )
 
 
 def _session_id_from_time_now():
@@ -128,40 +591,166 @@ def _idx_from_JB_name(JB_name):
     return int(idx_str)
 
 
-def _has_invalid_or_non_empty_stderr(work_dir, num_jobs):
-    has_errors = False
-    for idx in range(num_jobs):
-        e_path = _job_path(work_dir, idx) + ".e"
-        try:
-            if os.stat(e_path).st_size != 0:
-                has_errors = True
-        except FileNotFoundError:
-            has_errors = True
-    return has_errors
+def _scan_work_dir(work_dir, suffixes=(".out", ".e", ".npy")):
+    """
+    Returns a dict mapping the filenames in work_dir to their sizes in bytes.
+    The work_dir is listed only once using os.scandir. This avoids one
+    round-trip to the network-file-system for each file we are looking for.
+    Only files ending with one of the suffixes are stat'ed and indexed.
+    Temporary files of the network_file_system are ignored.
+    """
+    sizes = {}
+    with os.scandir(work_dir) as it:
+        for entry in it:
+            if not entry.name.endswith(suffixes):
+                continue
+            try:
+                sizes[entry.name] = entry.stat().st_size
+            except FileNotFoundError:
+                pass
+    return sizes
+
+
+def _job_status_table(work_dir_sizes, idxs):
+    """
+    Returns a list with one dict for each job in idxs. The sizes of the job's
+    result and stderr are None when the files do not exist. The size of a
+    result includes its .npy-files, see queue_map_reduce.npy_results.
+    """
+    npy_sizes = {}
+    for name in work_dir_sizes:
+        if name.endswith(".npy"):
+            result_name = name.rsplit(".", 2)[0]
+            npy_sizes.setdefault(result_name, 0)
+            npy_sizes[result_name] += work_dir_sizes[name]
+
+    table = []
+    for idx in idxs:
+        filename = _job_filename(idx)
+        result_size = work_dir_sizes.get(filename + ".out", None)
+        if result_size is not None:
+            result_size += npy_sizes.get(filename + ".out", 0)
+        table.append(
+            {
+                "idx": idx,
+                "result_size": result_size,
+                "stderr_size": work_dir_sizes.get(filename + ".e", None),
+            }
+        )
+    return table
+
+
+def _has_invalid_or_non_empty_stderr(job_status_table):
+    for job_status in job_status_table:
+        if job_status["stderr_size"] is None:
+            return True
+        if job_status["stderr_size"] != 0:
+            return True
+    return False
+
+
+def _read_result(path):
+    return pickle.loads(nfs.read(path=path, mode="rb"))
+
+
+def _pop_result(window):
+    future = window.popleft()
+    if future is None:
+        return None
+    return future.result()
+
+
+def _read_results(
+    result_paths, num_workers=1, pool="thread", read_result=_read_result
+):
+    """
+    Yields the results read from result_paths while keeping their order.
+    A path which is None yields None. Each result is read using
+    read_result(path).
+
+    Reading from a network-file-system is bound by its latency. With
+    num_workers > 1, the results are read ahead by a pool of workers.
+    At most 2 * num_workers results are read ahead so the memory stays
+    bounded. With pool = "thread" the pool shares our process. With
+    pool = "process" a worker unpickles the result, and the pool pickles it
+    again to send it back to our process, where it is unpickled once more.
+    So our process does not unpickle less than with threads. The processes
+    only isolate the reading from our process.
+    """
+    if num_workers <= 1:
+        for path in result_paths:
+            yield None if path is None else read_result(path)
+        return
+
+    if pool == "thread":
+        Executor = concurrent.futures.ThreadPoolExecutor
+    elif pool == "process":
+        Executor = concurrent.futures.ProcessPoolExecutor
+    else:
+        raise ValueError("Unknown pool '{:s}'.".format(pool))
+
+    window = collections.deque()
+    with Executor(max_workers=num_workers) as executor:
+        for path in result_paths:
+            if path is None:
+                window.append(None)
+            else:
+                window.append(executor.submit(read_result, path))
+            if len(window) >= 2 * num_workers:
+                yield _pop_result(window)
+        while window:
+            yield _pop_result(window)
 
 
-def __qdel(JB_job_number, qdel_path):
+def __qdel(JB_job_numbers, qdel_path):
+    cmd = [qdel_path]
+    for JB_job_number in JB_job_numbers:
+        cmd += [str(JB_job_number)]
     try:
-        _ = subprocess.check_output(
-            [qdel_path, str(JB_job_number)], stderr=subprocess.STDOUT,
-        )
+        _ = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
     except subprocess.CalledProcessError as e:
-        _log("qdel returncode: {:s}".format(e.returncode))
-        _log("qdel stdout: {:s}".format(e.output))
+        _log("qdel returncode: {:d}".format(e.returncode))
+        _log("qdel stdout: ", e.output)
         raise
 
 
-def _qdel(JB_job_number, qdel_path):
-    while True:
-        try:
-            __qdel(JB_job_number, qdel_path)
+def _qdel(JB_job_numbers, qdel_path, qstat_path, max_num_trials):
+    """
+    Deletes all the jobs with a single call of qdel.
+    When qdel fails, e.g. because one of the jobs just left the queue, qstat
+    is called to find the jobs which are still in the queue. Only these are
+    tried again, but only max_num_trials times.
+    Only except KeyboardInterrupt to stop.
+    Returns the JB_job_numbers which are still in the queue. This is empty
+    when all jobs are gone.
+    """
+    remaining = [str(JB_job_number) for JB_job_number in JB_job_numbers]
+    for trial in range(max_num_trials):
+        if not remaining:
             break
+        try:
+            __qdel(JB_job_numbers=remaining, qdel_path=qdel_path)
+            return []
         except KeyboardInterrupt:
             raise
         except Exception as bad:
             _log("Problem in qdel")
             print(bad)
+        remaining = _JB_job_numbers_in_queue(
+            JB_job_numbers=remaining, qstat_path=qstat_path
+        )
+        if remaining:
             time.sleep(1)
+    return remaining
+
+
+def _JB_job_numbers_in_queue(JB_job_numbers, qstat_path):
+    """
+    Returns the JB_job_numbers which are still running, or pending.
+    """
+    running, pending = _qstat(qstat_path=qstat_path)
+    in_queue = set(job["JB_job_number"] for job in running + pending)
+    return [n for n in JB_job_numbers if n in in_queue]
 
 
 def _qstat(qstat_path):
@@ -227,59 +816,1053 @@ def _jobs_running_pending_error(
     )
 
 
-def map_reduce(
-    function,
-    jobs,
-    queue_name=None,
-    python_path=os.path.abspath(shutil.which("python")),
+def _qdel_all(
+    JB_names_set,
+    error_state_indicator,
+    qstat_path,
+    qdel_path,
+    max_num_trials,
     polling_interval_qstat=5,
-    work_dir=None,
-    keep_work_dir=False,
-    max_num_resubmissions=10,
-    qsub_path="qsub",
-    qstat_path="qstat",
-    qdel_path="qdel",
-    error_state_indicator="E",
 ):
     """
-    Maps jobs to a function for embarrassingly parallel processing on a qsub
-    computing-cluster.
+    Deletes all jobs in JB_names_set which are still in the queue with a
+    single call of qdel. Jobs which leave the queue in the meantime are
+    not tried again, see _qdel.
+    A running job does not leave the queue at once when it is deleted, and
+    might still write into the work_dir. So qstat is polled until none of
+    the jobs is in the queue anymore, but only max_num_trials times.
+    Returns the JB_names of the jobs which are still in the queue, or which
+    qdel could not delete.
+    """
+    (
+        jobs_running,
+        jobs_pending,
+        jobs_error,
+    ) = _jobs_running_pending_error(
+        JB_names_set=JB_names_set,
+        error_state_indicator=error_state_indicator,
+        qstat_path=qstat_path,
+    )
+    jobs_remaining = jobs_running + jobs_pending + jobs_error
+    if not jobs_remaining:
+        return set()
+
+    _log("Deleting {:d} remaining jobs".format(len(jobs_remaining)))
+    JB_job_numbers_not_deleted = _qdel(
+        JB_job_numbers=[job["JB_job_number"] for job in jobs_remaining],
+        qdel_path=qdel_path,
+        qstat_path=qstat_path,
+        max_num_trials=max_num_trials,
+    )
+    JB_names_not_deleted = set()
+    for job in jobs_remaining:
+        if str(job["JB_job_number"]) in JB_job_numbers_not_deleted:
+            JB_names_not_deleted.add(job["JB_name"])
 
-    This for loop:
+    JB_names_in_queue = set()
+    for trial in range(max_num_trials):
+        (
+            jobs_running,
+            jobs_pending,
+            jobs_error,
+        ) = _jobs_running_pending_error(
+            JB_names_set=JB_names_set,
+            error_state_indicator=error_state_indicator,
+            qstat_path=qstat_path,
+        )
+        JB_names_in_queue = set(
+            job["JB_name"] for job in jobs_running + jobs_pending + jobs_error
+        )
+        if not JB_names_in_queue:
+            break
+        time.sleep(polling_interval_qstat)
+    return JB_names_not_deleted | JB_names_in_queue
 
-    >    results = []
-    >    for job in jobs:
-    >        results.append(function(job))
 
-    will be executed in parallel on a qsub computing-cluster in order to obtain
-    results.
-    Both the jobs and results must be serializable using pickle.
-    The function must be part of an installed python-module.
+def _submit_and_wait(
+    batch_jobs,
+    num_resubmissions_path,
+    queue_name,
+    python_path,
+    polling_interval_qstat,
+    max_num_resubmissions,
+    qsub_path,
+    qstat_path,
+    qdel_path,
+    error_state_indicator,
+    qsub_num_threads,
+    max_num_trials_qsub_qdel,
+    resource_escalation_factor=1.0,
+    max_num_resource_escalations=3,
+    usage_dir=None,
+    session_metrics=None,
+    metrics_json_lines_path=None,
+    metrics_prometheus_textfile_path=None,
+    stats=None,
+    on_finished=None,
+    move_pending_jobs_between_queues=False,
+    next_batch_jobs=None,
+    JB_names_left_in_queue=None,
+    phase_prefix="",
+):
+    """
+    Submits the batch-jobs and waits until none of them is running or
+    pending anymore. All batch-jobs found in error-state are deleted with a
+    single call of qdel, and resubmitted until they reached
+    max_num_resubmissions. The resubmissions are counted for each JB_name,
+    so each stage of a pipeline has its own budget. Their numbers are
+    written to num_resubmissions_path.
+    A resubmitted batch-job requests more resources, see _escalate_resources,
+    but only for its first max_num_resource_escalations resubmissions. After
+    this, its resources stay flat.
+    The usages of the completed jobs are read from usage_dir, if given.
+    The session_metrics, if given, are updated and exported after each call
+    of qstat.
+    The wall-times of submitting and waiting are added to stats, if given,
+    in the phases 'submitting' and 'waiting' prefixed by phase_prefix.
+    After each call of qstat, on_finished(finished_batch_jobs), if given, is
+    called with the batch-jobs which finished since the last call. When it
+    returns True, all remaining batch-jobs are deleted with a single call of
+    qdel, and we stop waiting. The JB_names of the batch-jobs which are
+    still in the queue after this are added to the set
+    JB_names_left_in_queue, if given, see _qdel_all.
+    After each call of qstat, next_batch_jobs(finished_batch_jobs), if
+    given, returns new batch-jobs which are submitted right away, and waited
+    for just like the others.
+    When queue_name is a list, the batch-jobs are spread across these
+    queues, see queue_map_reduce.queue_balancer. With
+    move_pending_jobs_between_queues, pending batch-jobs in a slow queue
+    are deleted and submitted again to the fastest queue.
+    Returns the summary of the usages read.
+    """
+    _log("Submitting jobs")
+    submit_start = time.time()
+    if isinstance(queue_name, (list, tuple)):
+        balancer = queue_balancer.init(queue_names=queue_name)
+        queue_balancer.assign(balancer=balancer, batch_jobs=batch_jobs)
+    else:
+        balancer = None
+    failed_batch_jobs = _qsub_batch_jobs(
+        batch_jobs=batch_jobs,
+        qsub_path=qsub_path,
+        queue_name=queue_name,
+        python_path=python_path,
+        num_threads=qsub_num_threads,
+        max_num_trials=max_num_trials_qsub_qdel,
+    )
+    if failed_batch_jobs:
+        raise RuntimeError(
+            "Failed to submit {:d} batch-jobs.".format(len(failed_batch_jobs))
+        )
+    _add_to_phase(
+        stats=stats,
+        phase=phase_prefix + "submitting",
+        wall_time_s=time.time() - submit_start,
+        count=len(batch_jobs),
+    )
 
-    Parameters
-    ----------
-    function : function-pointer
-        Pointer to a function in a python module. It must have both:
-        function.__module__
-        function.__name__
-    jobs : list
-        List of jobs. A job in the list must be a valid input to function.
-    queue_name : string, optional
-        Name of the queue to submit jobs to.
-    python_path : string, optional
-        The python path to be used on the computing-cluster's worker-nodes to
-        execute the worker-node's python-script.
-    polling_interval_qstat : float, optional
-        The time in seconds to wait before polling qstat again while waiting
-        for the jobs to finish.
-    work_dir : string, optional
-        The directory path where the jobs, the results and the
-        worker-node-script is stored.
+    _log("Waiting for jobs to finish")
+    wait_start = time.time()
+    num_qstat_calls = 0
+
+    batch_jobs_by_JB_name = {bj["JB_name"]: bj for bj in batch_jobs}
+    JB_names_in_session_set = set(batch_jobs_by_JB_name.keys())
+    still_running = True
+    num_resubmissions_by_JB_name = {}
+    num_escalations_by_JB_name = {}
+    JB_names_lost = set()
+    usage_summary = _init_usage_summary()
+    read_usage_filenames = set()
+    JB_names_unfinished = set(JB_names_in_session_set)
+    while still_running:
+        qstat_start = time.time()
+        (
+            jobs_running,
+            jobs_pending,
+            jobs_error,
+        ) = _jobs_running_pending_error(
+            JB_names_set=JB_names_in_session_set,
+            error_state_indicator=error_state_indicator,
+            qstat_path=qstat_path,
+        )
+        qstat_latency_s = time.time() - qstat_start
+        num_qstat_calls += 1
+        JB_names_running = set(j["JB_name"] for j in jobs_running)
+        JB_names_pending = set(j["JB_name"] for j in jobs_pending)
+        JB_names_error = set(j["JB_name"] for j in jobs_error)
+
+        if session_metrics is not None:
+            metrics.update(
+                metrics=session_metrics,
+                JB_names_running=JB_names_running,
+                JB_names_pending=JB_names_pending,
+                JB_names_error=JB_names_error,
+                qstat_latency_s=qstat_latency_s,
+                num_jobs_by_JB_name={
+                    JB_name: _num_jobs_in_batch_job(batch_job)
+                    for JB_name, batch_job in batch_jobs_by_JB_name.items()
+                },
+                JB_names_lost=JB_names_lost,
+            )
+            metrics.export(
+                metrics=session_metrics,
+                json_lines_path=metrics_json_lines_path,
+                prometheus_textfile_path=metrics_prometheus_textfile_path,
+            )
+        if balancer is not None:
+            queue_balancer.update(
+                balancer=balancer,
+                JB_names_running=JB_names_running,
+                JB_names_pending=JB_names_pending,
+                JB_names_error=JB_names_error,
+            )
+        num_running = len(jobs_running)
+        num_pending = len(jobs_pending)
+        num_error = len(jobs_error)
+        num_lost = len(JB_names_lost)
+
+        _log(
+            "{: 4d} running, {: 4d} pending, {: 4d} error, {: 4d} lost".format(
+                num_running, num_pending, num_error, num_lost,
+            )
+        )
+
+        batch_jobs_to_resubmit = []
+        for job in jobs_error:
+            JB_name = job["JB_name"]
+            idx = _idx_from_JB_name(JB_name)
+            if JB_name in num_resubmissions_by_JB_name:
+                num_resubmissions_by_JB_name[JB_name] += 1
+            else:
+                num_resubmissions_by_JB_name[JB_name] = 1
+
+            job_id_str = "JB_name {:s}, JB_job_number {:s}, idx {:09d}".format(
+                job["JB_name"], job["JB_job_number"], idx
+            )
+            _log("Found error-state in ", job_id_str)
+
+            if num_resubmissions_by_JB_name[JB_name] <= max_num_resubmissions:
+                _log(
+                    "Resubmitting {:d} of {:d}, JB_name {:s}".format(
+                        num_resubmissions_by_JB_name[JB_name],
+                        max_num_resubmissions,
+                        job["JB_name"],
+                    )
+                )
+                batch_jobs_to_resubmit.append(
+                    batch_jobs_by_JB_name[job["JB_name"]]
+                )
+            else:
+                JB_names_lost.add(job["JB_name"])
+
+        if jobs_error:
+            _log("Deleting {:d} jobs in error-state".format(num_error))
+            JB_job_numbers_not_deleted = _qdel(
+                JB_job_numbers=[job["JB_job_number"] for job in jobs_error],
+                qdel_path=qdel_path,
+                qstat_path=qstat_path,
+                max_num_trials=max_num_trials_qsub_qdel,
+            )
+            JB_names_not_deleted = set()
+            for job in jobs_error:
+                if job["JB_job_number"] in JB_job_numbers_not_deleted:
+                    JB_names_not_deleted.add(job["JB_name"])
+            batch_jobs_deleted = []
+            for batch_job in batch_jobs_to_resubmit:
+                if batch_job["JB_name"] in JB_names_not_deleted:
+                    # Its copy would share its JB_name. Try again next time.
+                    _log("Failed to delete JB_name ", batch_job["JB_name"])
+                    num_resubmissions_by_JB_name[batch_job["JB_name"]] -= 1
+                else:
+                    batch_jobs_deleted.append(batch_job)
+            batch_jobs_to_resubmit = batch_jobs_deleted
+
+        if batch_jobs_to_resubmit and usage_dir is not None:
+            _update_usage_summary(
+                usage_summary=usage_summary,
+                usage_dir=usage_dir,
+                read_usage_filenames=read_usage_filenames,
+            )
+
+        for batch_job in batch_jobs_to_resubmit:
+            JB_name = batch_job["JB_name"]
+            num_escalations = num_escalations_by_JB_name.get(JB_name, 0)
+            if num_escalations >= max_num_resource_escalations:
+                continue
+            if batch_job["resources"]:
+                num_escalations_by_JB_name[JB_name] = num_escalations + 1
+                batch_job["resources"] = _escalate_resources(
+                    resources=batch_job["resources"],
+                    factor=resource_escalation_factor,
+                    usage_summary=usage_summary,
+                )
+                _log(
+                    "Resources of JB_name ",
+                    batch_job["JB_name"],
+                    " ",
+                    batch_job["resources"],
+                )
+
+        if balancer is not None:
+            queue_balancer.assign(
+                balancer=balancer, batch_jobs=batch_jobs_to_resubmit
+            )
+        failed_batch_jobs = _qsub_batch_jobs(
+            batch_jobs=batch_jobs_to_resubmit,
+            qsub_path=qsub_path,
+            queue_name=queue_name,
+            python_path=python_path,
+            num_threads=qsub_num_threads,
+            max_num_trials=max_num_trials_qsub_qdel,
+        )
+        for batch_job in failed_batch_jobs:
+            _log("Failed to resubmit JB_name ", batch_job["JB_name"])
+            JB_names_lost.add(batch_job["JB_name"])
+        num_resubmitted = len(batch_jobs_to_resubmit) - len(failed_batch_jobs)
+
+        if jobs_error:
+            nfs.write(
+                content=json.dumps(num_resubmissions_by_JB_name, indent=4),
+                path=num_resubmissions_path,
+                mode="wt",
+            )
+
+        if balancer is not None and move_pending_jobs_between_queues:
+            JB_names_to_move = queue_balancer.JB_names_to_move(
+                balancer=balancer, JB_names_pending=JB_names_pending,
+            )
+            if JB_names_to_move:
+                _move_pending_batch_jobs(
+                    batch_jobs=[
+                        batch_jobs_by_JB_name[n] for n in JB_names_to_move
+                    ],
+                    jobs_pending=jobs_pending,
+                    balancer=balancer,
+                    qsub_path=qsub_path,
+                    qdel_path=qdel_path,
+                    qstat_path=qstat_path,
+                    python_path=python_path,
+                    qsub_num_threads=qsub_num_threads,
+                    max_num_trials_qsub_qdel=max_num_trials_qsub_qdel,
+                )
+
+        num_submitted_next = 0
+        if on_finished is not None or next_batch_jobs is not None:
+            JB_names_not_finished = set()
+            for job in jobs_running + jobs_pending:
+                JB_names_not_finished.add(job["JB_name"])
+            for batch_job in batch_jobs_to_resubmit:
+                if batch_job not in failed_batch_jobs:
+                    JB_names_not_finished.add(batch_job["JB_name"])
+            JB_names_finished = JB_names_unfinished - JB_names_not_finished
+            JB_names_unfinished = JB_names_not_finished
+            finished_batch_jobs = []
+            for JB_name in sorted(JB_names_finished):
+                finished_batch_jobs.append(batch_jobs_by_JB_name[JB_name])
+            if (
+                on_finished is not None
+                and finished_batch_jobs
+                and on_finished(finished_batch_jobs)
+            ):
+                _log("Stop-condition is met")
+                JB_names_left = _qdel_all(
+                    JB_names_set=JB_names_in_session_set,
+                    error_state_indicator=error_state_indicator,
+                    qstat_path=qstat_path,
+                    qdel_path=qdel_path,
+                    max_num_trials=max_num_trials_qsub_qdel,
+                    polling_interval_qstat=polling_interval_qstat,
+                )
+                if JB_names_left:
+                    _log(
+                        "{:d} jobs are still in the queue".format(
+                            len(JB_names_left)
+                        )
+                    )
+                if JB_names_left_in_queue is not None:
+                    JB_names_left_in_queue.update(JB_names_left)
+                break
+
+            if next_batch_jobs is not None and finished_batch_jobs:
+                new_batch_jobs = next_batch_jobs(finished_batch_jobs)
+                if new_batch_jobs:
+                    _log(
+                        "Submitting {:d} next jobs".format(len(new_batch_jobs))
+                    )
+                if balancer is not None:
+                    queue_balancer.assign(
+                        balancer=balancer, batch_jobs=new_batch_jobs
+                    )
+                failed_batch_jobs = _qsub_batch_jobs(
+                    batch_jobs=new_batch_jobs,
+                    qsub_path=qsub_path,
+                    queue_name=queue_name,
+                    python_path=python_path,
+                    num_threads=qsub_num_threads,
+                    max_num_trials=max_num_trials_qsub_qdel,
+                )
+                for batch_job in new_batch_jobs:
+                    if batch_job in failed_batch_jobs:
+                        _log("Failed to submit JB_name ", batch_job["JB_name"])
+                        continue
+                    batch_jobs_by_JB_name[batch_job["JB_name"]] = batch_job
+                    JB_names_in_session_set.add(batch_job["JB_name"])
+                    JB_names_unfinished.add(batch_job["JB_name"])
+                    num_submitted_next += 1
+
+        if (
+            num_running == 0
+            and num_pending == 0
+            and num_resubmitted == 0
+            and num_submitted_next == 0
+        ):
+            still_running = False
+
+        time.sleep(polling_interval_qstat)
+
+    if usage_dir is not None:
+        _update_usage_summary(
+            usage_summary=usage_summary,
+            usage_dir=usage_dir,
+            read_usage_filenames=read_usage_filenames,
+        )
+    if balancer is not None:
+        _log("Queues ", queue_balancer.to_str(balancer))
+    _add_to_phase(
+        stats=stats,
+        phase=phase_prefix + "waiting",
+        wall_time_s=time.time() - wait_start,
+        count=num_qstat_calls,
+    )
+    return usage_summary
+
+
+def _move_pending_batch_jobs(
+    batch_jobs,
+    jobs_pending,
+    balancer,
+    qsub_path,
+    qdel_path,
+    qstat_path,
+    python_path,
+    qsub_num_threads,
+    max_num_trials_qsub_qdel,
+):
+    """
+    Deletes the pending batch-jobs with a single call of qdel, and submits
+    them again to the fastest queue of the balancer. Every batch-job which
+    is not in the queue anymore is submitted again, even when qdel failed
+    for some of the others. The batch-jobs which are still in the queue stay
+    where they are.
+    """
+    JB_job_number_by_JB_name = {}
+    for job in jobs_pending:
+        JB_job_number_by_JB_name[job["JB_name"]] = str(job["JB_job_number"])
+    _log(
+        "Moving {:d} pending jobs to queue {:s}".format(
+            len(batch_jobs), str(queue_balancer.fastest_queue_name(balancer))
+        )
+    )
+    _log("Queues ", queue_balancer.to_str(balancer))
+    JB_job_numbers_not_deleted = _qdel(
+        JB_job_numbers=[
+            JB_job_number_by_JB_name[batch_job["JB_name"]]
+            for batch_job in batch_jobs
+        ],
+        qdel_path=qdel_path,
+        qstat_path=qstat_path,
+        max_num_trials=max_num_trials_qsub_qdel,
+    )
+    deleted_batch_jobs = []
+    for batch_job in batch_jobs:
+        JB_job_number = JB_job_number_by_JB_name[batch_job["JB_name"]]
+        if JB_job_number in JB_job_numbers_not_deleted:
+            _log("Failed to delete JB_name ", batch_job["JB_name"])
+        else:
+            deleted_batch_jobs.append(batch_job)
+    batch_jobs = deleted_batch_jobs
+    queue_balancer.move(balancer=balancer, batch_jobs=batch_jobs)
+    failed_batch_jobs = _qsub_batch_jobs(
+        batch_jobs=batch_jobs,
+        qsub_path=qsub_path,
+        queue_name=None,
+        python_path=python_path,
+        num_threads=qsub_num_threads,
+        max_num_trials=max_num_trials_qsub_qdel,
+    )
+    for batch_job in failed_batch_jobs:
+        _log("Failed to move JB_name ", batch_job["JB_name"])
+
+
+def _read_landed_results(
+    finished_batch_jobs,
+    landed,
+    idxs_by_unique_idx,
+    stop_when,
+    work_dir,
+    read_result=_read_result,
+    session_metrics=None,
+    result_num_bytes=os.path.getsize,
+):
+    """
+    Reads the results of the finished batch-jobs into landed["results"], and
+    returns stop_when(landed["results"]). Once this is True,
+    landed["stopped"] is set True.
+    The bytes read, as given by result_num_bytes, are added to the
+    session_metrics, if given.
+    """
+    for batch_job in finished_batch_jobs:
+        for unique_idx in batch_job["idxs"]:
+            result_path = _job_path(work_dir, unique_idx) + ".out"
+            try:
+                result = read_result(result_path)
+            except FileNotFoundError:
+                continue
+            if session_metrics is not None:
+                session_metrics["bytes_read"] += result_num_bytes(result_path)
+            landed["unique_idxs"].add(unique_idx)
+            for idx in idxs_by_unique_idx[unique_idx]:
+                landed["results"][idx] = result
+    if stop_when(landed["results"]):
+        landed["stopped"] = True
+    return landed["stopped"]
+
+
+def _stage_dir(work_dir, stage):
+    return os.path.abspath(
+        os.path.join(work_dir, "stage_{:02d}".format(stage))
+    )
+
+
+def _make_stage_batch_job(work_dir, session_id, stage, idx):
+    batch_job = _make_batch_job(
+        JB_name=_make_JB_name(
+            session_id="{:s}s{:02d}".format(session_id, stage), idx=idx,
+        ),
+        script_path=os.path.join(
+            _stage_dir(work_dir, stage), "worker_node_script.py"
+        ),
+        job_path=_job_path(_stage_dir(work_dir, stage), idx),
+        idxs=[idx],
+    )
+    batch_job["stage"] = stage
+    return batch_job
+
+
+def _next_stage_batch_jobs(
+    finished_batch_jobs, work_dir, session_id, num_stages
+):
+    """
+    Returns the batch-jobs of the next stage for the finished batch-jobs
+    which wrote their result. The job of the next stage is not written, it
+    is the result of the stage before.
+    The directory of each stage with finished batch-jobs is listed only
+    once, see _scan_work_dir.
+    """
+    work_dir_sizes_by_stage = {}
+    next_batch_jobs = []
+    for batch_job in finished_batch_jobs:
+        stage = batch_job["stage"] + 1
+        if stage == num_stages:
+            continue
+        if batch_job["stage"] not in work_dir_sizes_by_stage:
+            work_dir_sizes_by_stage[batch_job["stage"]] = _scan_work_dir(
+                work_dir=_stage_dir(work_dir, batch_job["stage"]),
+                suffixes=(".out",),
+            )
+        result_filename = os.path.basename(batch_job["arguments"][0]) + ".out"
+        if result_filename not in work_dir_sizes_by_stage[batch_job["stage"]]:
+            continue
+        next_batch_jobs.append(
+            _make_stage_batch_job(
+                work_dir=work_dir,
+                session_id=session_id,
+                stage=stage,
+                idx=batch_job["idxs"][0],
+            )
+        )
+    return next_batch_jobs
+
+
+_TRASH_CLAIM_SUFFIX = ".claimed"
+_TRASH_CLAIM_TIMEOUT_S = 24 * 3600
+
+
+def _trash_dir(work_dir):
+    return os.path.join(
+        os.path.dirname(os.path.abspath(work_dir)), ".qsub_trash"
+    )
+
+
+_REMOVE_IN_BACKGROUND_SCRIPT = """\
+import subprocess
+import sys
+subprocess.Popen(
+    [
+        sys.executable,
+        "-c",
+        "import shutil, sys\\nshutil.rmtree(sys.argv[1], ignore_errors=True)",
+        sys.argv[1],
+    ],
+    stdin=subprocess.DEVNULL,
+    stdout=subprocess.DEVNULL,
+    stderr=subprocess.DEVNULL,
+    start_new_session=True,
+)
+"""
+
+
+def _remove_in_background(path):
+    """
+    Removes path in a process which keeps running even when our process
+    exits. The process is detached by a double fork: An intermediate process
+    starts the removal and exits right away. We wait for the intermediate
+    process, so no handle and no zombie is left behind. The removal itself
+    is adopted by init.
+    """
+    subprocess.run(
+        [sys.executable, "-c", _REMOVE_IN_BACKGROUND_SCRIPT, path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+
+
+def _move_to_trash_and_remove_in_background(work_dir):
+    """
+    Moves the work_dir atomically into the trash_dir next to it, and removes
+    it there in the background. Its name in the trash_dir is claimed, see
+    _sweep_trash. Returns the path in the trash_dir.
+    """
+    trash_dir = _trash_dir(work_dir)
+    os.makedirs(trash_dir, exist_ok=True)
+    trash_path = os.path.join(
+        trash_dir,
+        "{:s}.{:s}{:s}".format(
+            os.path.basename(os.path.abspath(work_dir)),
+            str(uuid.uuid4()),
+            _TRASH_CLAIM_SUFFIX,
+        ),
+    )
+    os.rename(work_dir, trash_path)
+    _remove_in_background(path=trash_path)
+    return trash_path
+
+
+def _sweep_trash(work_dir):
+    """
+    Removes what is left in the trash_dir next to work_dir, e.g. by a map()
+    which crashed before its removal in the background finished.
+    Each entry is claimed by an atomic rename before its removal is started.
+    So only one process removes it, even when multiple calls of map() sweep
+    at the same time. A claimed entry is skipped, unless it was not modified
+    for _TRASH_CLAIM_TIMEOUT_S, i.e. its removal died.
+    """
+    trash_dir = _trash_dir(work_dir)
+    if not os.path.isdir(trash_dir):
+        return
+    now = time.time()
+    with os.scandir(trash_dir) as it:
+        entries = list(it)
+    for entry in entries:
+        if entry.name.endswith(_TRASH_CLAIM_SUFFIX):
+            try:
+                age_s = now - entry.stat(follow_symlinks=False).st_mtime
+            except FileNotFoundError:
+                continue
+            if age_s < _TRASH_CLAIM_TIMEOUT_S:
+                continue
+        claimed_path = os.path.join(
+            trash_dir, str(uuid.uuid4()) + _TRASH_CLAIM_SUFFIX
+        )
+        try:
+            os.rename(entry.path, claimed_path)
+        except FileNotFoundError:
+            # Claimed, or removed by someone else.
+            continue
+        _remove_in_background(path=claimed_path)
+
+
+def _add_to_phase(stats, phase, wall_time_s, count=0, num_bytes=0):
+    """
+    Adds the wall-time, the count, and the bytes to the phase in stats.
+    Nothing is done when stats is None.
+    """
+    if stats is None:
+        return
+    if phase not in stats:
+        stats[phase] = {"wall_time_s": 0.0, "count": 0, "bytes": 0}
+    stats[phase]["wall_time_s"] += wall_time_s
+    stats[phase]["count"] += count
+    stats[phase]["bytes"] += num_bytes
+
+
+def _fold_results(reducer, result_paths, read_results):
+    """
+    Folds the results in result_paths in their order. A path which is None
+    is skipped. The results are read using read_results(unique_paths).
+    A path which occurs multiple times, e.g. because of deduplicated jobs,
+    is read only once, and its result is kept only until its last use.
+    """
+    num_uses_left = collections.Counter(
+        [path for path in result_paths if path is not None]
+    )
+    unique_results_iter = read_results(list(num_uses_left.keys()))
+    results_by_path = {}
+    initial, fold_function = reducer
+    accumulator = initial
+    for result_path in result_paths:
+        if result_path is None:
+            continue
+        if result_path not in results_by_path:
+            results_by_path[result_path] = next(unique_results_iter)
+        result = results_by_path[result_path]
+        num_uses_left[result_path] -= 1
+        if num_uses_left[result_path] == 0:
+            del results_by_path[result_path]
+        accumulator = fold_function(accumulator, result)
+    return accumulator
+
+
+def _fold_paths(initial, fold_function, paths):
+    accumulator = initial
+    for path in paths:
+        accumulator = fold_function(accumulator, _read_result(path))
+    return accumulator
+
+
+def _tree_reduce(
+    reducer,
+    result_paths,
+    group_size,
+    work_dir,
+    session_id,
+    queue_name,
+    python_path,
+    polling_interval_qstat,
+    max_num_resubmissions,
+    qsub_path,
+    qstat_path,
+    qdel_path,
+    error_state_indicator,
+    qsub_num_threads,
+    max_num_trials_qsub_qdel,
+    stats=None,
+    session_metrics=None,
+):
+    """
+    Reduces the results in a tree of reduce-jobs on the queue.
+    In each level, the paths are split into groups of group_size. Each
+    group is folded by a reduce-job into a single accumulator. The
+    accumulators are the paths for the next level. This goes on until a
+    single accumulator is left which is read by us.
+    When a reduce-job did not write its accumulator, we fold its group
+    ourselves.
+    The wall-times of submitting and waiting for the reduce-jobs are added
+    to stats, if given, in the phases 'tree_reduce_submitting' and
+    'tree_reduce_waiting'. The bytes we read are added to the
+    session_metrics, if given.
+    Returns the accumulator, and whether all reduce-jobs succeeded.
+    """
+    initial, fold_function = reducer
+
+    script_path = os.path.join(work_dir, "reduce_node_script.py")
+    _log("Writing reduce-node-script", script_path)
+    reduce_node_script_str = _make_reduce_node_script(
+        module_name=fold_function.__module__,
+        function_name=fold_function.__name__,
+        environ=dict(os.environ),
+    )
+    nfs.write(content=reduce_node_script_str, path=script_path, mode="wt")
+    _make_path_executable(path=script_path)
+
+    reduce_jobs_succeeded = True
+    paths = list(result_paths)
+    level = 0
+    while len(paths) > 1:
+        level_dir = os.path.join(work_dir, "reduce_{:02d}".format(level))
+        os.makedirs(level_dir)
+        groups = []
+        for start in range(0, len(paths), group_size):
+            groups.append(paths[start : start + group_size])
+        _log(
+            "Reduce-level {:d}: {:d} paths in {:d} reduce-jobs".format(
+                level, len(paths), len(groups)
+            )
+        )
+
+        batch_jobs = []
+        for gidx, group in enumerate(groups):
+            nfs.write(
+                content=pickle.dumps({"initial": initial, "paths": group}),
+                path=_job_path(level_dir, gidx),
+                mode="wb",
+            )
+            batch_jobs.append(
+                _make_batch_job(
+                    JB_name=_make_JB_name(
+                        session_id="{:s}r{:02d}".format(session_id, level),
+                        idx=gidx,
+                    ),
+                    script_path=script_path,
+                    job_path=_job_path(level_dir, gidx),
+                )
+            )
+
+        _submit_and_wait(
+            batch_jobs=batch_jobs,
+            num_resubmissions_path=os.path.join(
+                level_dir, "num_resubmissions_by_JB_name.json"
+            ),
+            queue_name=queue_name,
+            python_path=python_path,
+            polling_interval_qstat=polling_interval_qstat,
+            max_num_resubmissions=max_num_resubmissions,
+            qsub_path=qsub_path,
+            qstat_path=qstat_path,
+            qdel_path=qdel_path,
+            error_state_indicator=error_state_indicator,
+            qsub_num_threads=qsub_num_threads,
+            max_num_trials_qsub_qdel=max_num_trials_qsub_qdel,
+            stats=stats,
+            phase_prefix="tree_reduce_",
+        )
+
+        level_status_table = _job_status_table(
+            work_dir_sizes=_scan_work_dir(work_dir=level_dir),
+            idxs=range(len(groups)),
+        )
+        if _has_invalid_or_non_empty_stderr(level_status_table):
+            reduce_jobs_succeeded = False
+            _log("Found non zero stderr in reduce-level ", level)
+
+        paths = []
+        for gidx, group in enumerate(groups):
+            accumulator_path = _job_path(level_dir, gidx) + ".out"
+            if level_status_table[gidx]["result_size"] is None:
+                reduce_jobs_succeeded = False
+                _log("No accumulator ", accumulator_path, ", folding here.")
+                accumulator = _fold_paths(
+                    initial=initial, fold_function=fold_function, paths=group,
+                )
+                if session_metrics is not None:
+                    for path in group:
+                        session_metrics["bytes_read"] += os.path.getsize(path)
+                nfs.write(
+                    content=pickle.dumps(accumulator),
+                    path=accumulator_path,
+                    mode="wb",
+                )
+            paths.append(accumulator_path)
+        level += 1
+
+    if len(paths) == 0:
+        return initial, reduce_jobs_succeeded
+    if session_metrics is not None:
+        session_metrics["bytes_read"] += os.path.getsize(paths[0])
+    return _read_result(paths[0]), reduce_jobs_succeeded
+
+
+def map_reduce(
+    function,
+    jobs,
+    queue_name=None,
+    python_path=os.path.abspath(shutil.which("python")),
+    polling_interval_qstat=5,
+    work_dir=None,
+    keep_work_dir=False,
+    max_num_resubmissions=10,
+    qsub_path="qsub",
+    qstat_path="qstat",
+    qdel_path="qdel",
+    error_state_indicator="E",
+    reduce_num_workers=1,
+    reduce_pool="thread",
+    reducer=None,
+    tree_reduce_group_size=None,
+    shared=None,
+    stage_on_worker_node=False,
+    worker_node_cache_dir=None,
+    qsub_num_threads=1,
+    max_num_trials_qsub_qdel=10,
+    job_memory_bytes=None,
+    job_runtime_s=None,
+    job_num_slots=1,
+    parallel_environment=None,
+    resource_escalation_factor=2.0,
+    max_num_resource_escalations=3,
+    metrics_json_lines_path=None,
+    metrics_prometheus_textfile_path=None,
+    return_stats=False,
+    deduplicate_jobs=False,
+    stop_when=None,
+    remove_work_dir_in_background=False,
+    num_jobs_per_batch_job=1,
+    move_pending_jobs_between_queues=False,
+    memory_map_results=False,
+):
+    """
+    Maps jobs to a function for embarrassingly parallel processing on a qsub
+    computing-cluster.
+
+    This for loop:
+
+    >    results = []
+    >    for job in jobs:
+    >        results.append(function(job))
+
+    will be executed in parallel on a qsub computing-cluster in order to obtain
+    results.
+    Both the jobs and results must be serializable using pickle.
+    The function must be part of an installed python-module.
+
+    Parameters
+    ----------
+    function : function-pointer
+        Pointer to a function in a python module. It must have both:
+        function.__module__
+        function.__name__
+    jobs : list
+        List of jobs. A job in the list must be a valid input to function.
+    queue_name : string, or list of strings, optional
+        Name of the queue to submit jobs to. When this is a list of names,
+        the jobs are spread across these queues. The split shifts toward
+        the queues where the jobs start and finish faster. See module
+        queue_map_reduce.queue_balancer.
+    python_path : string, optional
+        The python path to be used on the computing-cluster's worker-nodes to
+        execute the worker-node's python-script.
+    polling_interval_qstat : float, optional
+        The time in seconds to wait before polling qstat again while waiting
+        for the jobs to finish.
+    work_dir : string, optional
+        The directory path where the jobs, the results and the
+        worker-node-script is stored.
     keep_work_dir : bool, optional
         When True, the working directory will not be removed.
     max_num_resubmissions: int, optional
         In case of error-state in job, the job will be tried this often to be
         resubmitted befor giving up on it.
+    reduce_num_workers : int, optional
+        The number of workers reading the results in parallel from the
+        work_dir. The order of the results is kept.
+    reduce_pool : string, optional
+        Either "thread" or "process". Use "thread". With "process", each
+        result is unpickled by a worker, sent back pickled, and unpickled
+        again by map(). This does not save any unpickling in map(), and
+        costs an extra round-trip of pickling.
+    reducer : tuple(initial, fold_function), optional
+        When given, the results are not returned as a list. Instead, each
+        result is folded into an accumulator as soon as it is read using
+        accumulator = fold_function(accumulator, result), starting with
+        accumulator = initial. The final accumulator is returned. This way
+        only a few results live in memory at the same time. Missing results
+        are not folded.
+    tree_reduce_group_size : int, optional
+        When given together with the reducer, the results are reduced on the
+        queue in a tree of reduce-jobs. Each reduce-job folds a group of this
+        many results, or accumulators of the level before, until a single
+        accumulator is left. This requires that the fold_function is part of
+        an installed python-module, that it is associative, that the initial
+        is its identity, and that accumulators can be folded just like
+        results, e.g. reducer=(0, numpy.add).
+    shared : object, optional
+        A read-only payload which all jobs share, e.g. a large lookup-table.
+        When given, it is written only once into the work_dir instead of
+        into each job, and the function is called with function(job, shared).
+        Must be serializable using pickle.
+    stage_on_worker_node : bool, optional
+        When True, the worker-node-script copies the job into the
+        worker-node's local TMPDIR, writes the result there, and moves the
+        result back into the work_dir in a single step.
+    worker_node_cache_dir : string, optional
+        A directory on the local disks of the worker-nodes. When given, your
+        function can use queue_map_reduce.worker_node_cache.local_path(path)
+        to copy a read-only input-file only once onto a worker-node. All
+        jobs landing on this worker-node share this copy. We do not clean
+        up this directory.
+    qsub_num_threads : int, optional
+        The number of threads calling qsub in parallel to submit, and to
+        resubmit the jobs.
+    max_num_trials_qsub_qdel : int, optional
+        A call of qsub, or qdel, which fails is tried again, but only this
+        often. All jobs found in error-state are deleted with a single call
+        of qdel.
+    job_memory_bytes : int, optional
+        The hard limit of virtual memory 'h_vmem' requested for each job.
+    job_runtime_s : int, optional
+        The hard limit of wall-time 'h_rt' requested for each job.
+    job_num_slots : int, optional
+        The number of slots requested for each job in the
+        parallel_environment.
+    parallel_environment : string, optional
+        The name of the parallel environment to request job_num_slots in.
+        Slots are only requested when this is given.
+    resource_escalation_factor : float, optional
+        A job in error-state is resubmitted with its job_memory_bytes, and
+        job_runtime_s increased by this factor. Both are at least 25% above
+        the peak-memory, and wall-time observed in the completed jobs so far.
+    max_num_resource_escalations : int, optional
+        The resources of a job are escalated only for this many of its
+        resubmissions. After this, the job is resubmitted with the same
+        resources. This keeps a job which fails for other reasons, e.g. on
+        a bad worker-node, from requesting more than any node has.
+    metrics_json_lines_path : string, optional
+        While waiting for the jobs, the metrics of the progress are appended
+        to this file as json-lines after each call of qstat. See module
+        queue_map_reduce.metrics.
+    metrics_prometheus_textfile_path : string, optional
+        While waiting for the jobs, the metrics of the progress are written
+        atomically to this path in the textfile-format of the prometheus
+        node-exporter.
+    return_stats : bool, optional
+        When True, map() returns the tuple (results, stats). The stats
+        contain the wall-time, the count, and the bytes of each phase of
+        map(). These are writing the worker-node-script, pickling the jobs,
+        writing the jobs, submitting, waiting, scanning the work_dir,
+        reducing, and removing the work_dir.
+    deduplicate_jobs : bool, optional
+        When True, jobs which pickle into identical bytes are submitted only
+        once, and their result is used for all of them. Duplicate jobs then
+        share the same result-object. Do not use this when your function
+        does not return the same result for the same job, e.g. when it
+        draws random numbers.
+    stop_when : function, optional
+        When given, the results are read while the jobs finish, and
+        stop_when(results_so_far) is called after each call of qstat.
+        The results_so_far is a list just like the results with None for the
+        results which did not land yet. Once stop_when returns True, all
+        remaining jobs are deleted, and the results so far are returned.
+        When jobs are still in the queue after their deletion, the work_dir
+        is kept. Can not be used together with the reducer.
+    remove_work_dir_in_background : bool, optional
+        When True, the work_dir is not removed by map() itself. Instead, it
+        is moved atomically into the directory '.qsub_trash' next to it,
+        and removed there by a detached process. So map() returns right
+        away. What is left in '.qsub_trash' by earlier calls is removed as
+        well.
+    num_jobs_per_batch_job : int, optional
+        When larger than one, the jobs are submitted in bundles of this many
+        jobs. Each batch-job processes its bundle using a pool of
+        job_num_slots processes. Together with the parallel_environment this
+        uses all slots of a multi-slot allocation, or a whole worker-node.
+        A pool of more than one process requires the parallel_environment,
+        otherwise the processes would share a single slot.
+        Each job still gets its own result, stdout and stderr. The resources
+        are requested for the whole bundle.
+    move_pending_jobs_between_queues : bool, optional
+        When True, and queue_name is a list, jobs which are pending in a
+        queue which is much slower than the fastest queue are deleted, and
+        submitted again to the fastest queue. Each job is moved only once.
+    memory_map_results : bool, optional
+        When True, results which are numpy-arrays, or dicts of numpy-arrays,
+        are written in numpy's .npy-format, and are returned as read-only
+        memory-maps, i.e. numpy.load(path, mmap_mode="r"). Other results are
+        pickled as usual. Because the memory-maps read from the work_dir, the
+        work_dir is kept. Remove it when you are done with the results.
+        Can not be used together with the tree_reduce_group_size, or with
+        reduce_pool="process". See module queue_map_reduce.npy_results.
 
     Example
     -------
@@ -288,6 +1871,19 @@ def map_reduce(
         jobs=[numpy.arange(i, 100+i) for i in range(10)]
     )
     """
+    assert reduce_pool in ["thread", "process"]
+    if stop_when is not None:
+        assert reducer is None
+    if tree_reduce_group_size is not None:
+        assert reducer is not None
+        assert tree_reduce_group_size >= 2
+    assert num_jobs_per_batch_job >= 1
+    if num_jobs_per_batch_job > 1 and job_num_slots > 1:
+        assert parallel_environment is not None
+    assert max_num_resource_escalations >= 0
+    if memory_map_results:
+        assert tree_reduce_group_size is None
+        assert reduce_pool == "thread"
     session_id = _session_id_from_time_now()
     if work_dir is None:
         work_dir = os.path.abspath(os.path.join(".", ".qsub_" + session_id))
@@ -301,145 +1897,648 @@ def map_reduce(
     _log("polling-interval for qstat: ", polling_interval_qstat, "s")
     _log("max. num. resubmissions: ", max_num_resubmissions)
     _log("error-state-indicator: ", error_state_indicator)
+    _log("qsub-num-threads: ", qsub_num_threads)
+    _log("max. num. trials qsub, qdel: ", max_num_trials_qsub_qdel)
+    _log("job-memory-bytes: ", job_memory_bytes)
+    _log("job-runtime-s: ", job_runtime_s)
+    _log("job-num-slots: ", job_num_slots, parallel_environment)
+    _log("resource-escalation-factor: ", resource_escalation_factor)
+    _log("max-num-resource-escalations: ", max_num_resource_escalations)
+    _log("reduce-num-workers: ", reduce_num_workers, reduce_pool)
+    _log("stage-on-worker-node: ", stage_on_worker_node)
+    _log("worker-node-cache-dir: ", worker_node_cache_dir)
+    _log("deduplicate-jobs: ", deduplicate_jobs)
+    _log("remove-work-dir-in-background: ", remove_work_dir_in_background)
+    _log("num-jobs-per-batch-job: ", num_jobs_per_batch_job)
+    _log(
+        "move-pending-jobs-between-queues: ", move_pending_jobs_between_queues
+    )
+    _log("memory-map-results: ", memory_map_results)
+    if remove_work_dir_in_background:
+        _sweep_trash(work_dir=work_dir)
     _log("Making work_dir ", work_dir)
     os.makedirs(work_dir)
+    stats = {}
+
+    if shared is None:
+        shared_path = None
+    else:
+        shared_path = os.path.join(work_dir, "shared.pkl")
+        _log("Writing shared payload", shared_path)
+        phase_start = time.time()
+        shared_bytes = pickle.dumps(shared)
+        _add_to_phase(
+            stats=stats,
+            phase="pickling_jobs",
+            wall_time_s=time.time() - phase_start,
+            num_bytes=len(shared_bytes),
+        )
+        phase_start = time.time()
+        nfs.write(content=shared_bytes, path=shared_path, mode="wb")
+        _add_to_phase(
+            stats=stats,
+            phase="writing_jobs",
+            wall_time_s=time.time() - phase_start,
+            count=1,
+            num_bytes=len(shared_bytes),
+        )
+        _log("Shared payload has {:d} bytes".format(len(shared_bytes)))
+        del shared_bytes
 
+    phase_start = time.time()
     script_path = os.path.join(work_dir, "worker_node_script.py")
     _log("Writing worker-node-script", script_path)
-    worker_node_script_str = _make_worker_node_script(
-        module_name=function.__module__,
-        function_name=function.__name__,
-        environ=dict(os.environ),
-    )
+    measure_usage = job_memory_bytes is not None or job_runtime_s is not None
+    environ = dict(os.environ)
+    if worker_node_cache_dir is not None:
+        environ[worker_node_cache.CACHE_DIR_KEY] = worker_node_cache_dir
+    if num_jobs_per_batch_job == 1:
+        worker_node_script_str = _make_worker_node_script(
+            module_name=function.__module__,
+            function_name=function.__name__,
+            environ=environ,
+            shared_path=shared_path,
+            stage=stage_on_worker_node,
+            measure_usage=measure_usage,
+            npy_results=memory_map_results,
+        )
+    else:
+        worker_node_script_str = _make_bundle_worker_node_script(
+            module_name=function.__module__,
+            function_name=function.__name__,
+            environ=environ,
+            num_processes=job_num_slots,
+            shared_path=shared_path,
+            stage=stage_on_worker_node,
+            measure_usage=measure_usage,
+            npy_results=memory_map_results,
+        )
     nfs.write(content=worker_node_script_str, path=script_path, mode="wt")
     _make_path_executable(path=script_path)
+    _add_to_phase(
+        stats=stats,
+        phase="writing_worker_node_script",
+        wall_time_s=time.time() - phase_start,
+        count=1,
+        num_bytes=len(worker_node_script_str),
+    )
 
     _log("Mapping jobs into work_dir")
-    JB_names_in_session = []
+    unique_idx_by_digest = {}
+    unique_idx_by_idx = []
     for idx, job in enumerate(jobs):
-        JB_name = _make_JB_name(session_id=session_id, idx=idx)
-        JB_names_in_session.append(JB_name)
+        phase_start = time.time()
+        job_bytes = pickle.dumps(job)
+        _add_to_phase(
+            stats=stats,
+            phase="pickling_jobs",
+            wall_time_s=time.time() - phase_start,
+            count=1,
+            num_bytes=len(job_bytes),
+        )
+        if deduplicate_jobs:
+            digest = hashlib.sha256(job_bytes).hexdigest()
+            if digest in unique_idx_by_digest:
+                unique_idx_by_idx.append(unique_idx_by_digest[digest])
+                continue
+            unique_idx_by_digest[digest] = idx
+        unique_idx_by_idx.append(idx)
+        phase_stop = time.time()
         nfs.write(
-            content=pickle.dumps(job),
-            path=_job_path(work_dir, idx),
-            mode="wb",
+            content=job_bytes, path=_job_path(work_dir, idx), mode="wb",
+        )
+        _add_to_phase(
+            stats=stats,
+            phase="writing_jobs",
+            wall_time_s=time.time() - phase_stop,
+            count=1,
+            num_bytes=len(job_bytes),
         )
 
-    _log("Submitting jobs")
+    unique_idxs = sorted(set(unique_idx_by_idx))
+    _log(
+        "{:d} jobs, {:d} unique jobs, deduplication-ratio {:.3f}".format(
+            len(jobs),
+            len(unique_idxs),
+            len(jobs) / len(unique_idxs) if unique_idxs else 1.0,
+        )
+    )
 
-    for JB_name in JB_names_in_session:
-        idx = _idx_from_JB_name(JB_name)
-        _qsub(
-            qsub_path=qsub_path,
-            queue_name=queue_name,
-            script_exe_path=python_path,
-            script_path=script_path,
-            arguments=[_job_path(work_dir, idx)],
-            JB_name=JB_name,
-            stdout_path=_job_path(work_dir, idx) + ".o",
-            stderr_path=_job_path(work_dir, idx) + ".e",
+    batch_jobs = []
+    if num_jobs_per_batch_job == 1:
+        for idx in unique_idxs:
+            batch_jobs.append(
+                _make_batch_job(
+                    JB_name=_make_JB_name(session_id=session_id, idx=idx),
+                    script_path=script_path,
+                    job_path=_job_path(work_dir, idx),
+                    resources=_make_resources(
+                        memory_bytes=job_memory_bytes,
+                        runtime_s=job_runtime_s,
+                        num_slots=job_num_slots,
+                        parallel_environment=parallel_environment,
+                    ),
+                    idxs=[idx],
+                )
+            )
+    else:
+        _log("Bundling jobs into work_dir")
+        phase_start = time.time()
+        num_bundle_bytes = 0
+        for start in range(0, len(unique_idxs), num_jobs_per_batch_job):
+            bundle_idx = start // num_jobs_per_batch_job
+            bundle_idxs = unique_idxs[start : start + num_jobs_per_batch_job]
+            bundle_str = json.dumps(
+                [_job_path(work_dir, idx) for idx in bundle_idxs]
+            )
+            num_bundle_bytes += len(bundle_str)
+            nfs.write(
+                content=bundle_str,
+                path=_bundle_path(work_dir, bundle_idx),
+                mode="wt",
+            )
+            batch_jobs.append(
+                _make_batch_job(
+                    JB_name=_make_JB_name(
+                        session_id=session_id, idx=bundle_idx
+                    ),
+                    script_path=script_path,
+                    job_path=_bundle_path(work_dir, bundle_idx),
+                    resources=_make_resources(
+                        memory_bytes=job_memory_bytes,
+                        runtime_s=job_runtime_s,
+                        num_slots=job_num_slots,
+                        parallel_environment=parallel_environment,
+                    ),
+                    idxs=bundle_idxs,
+                )
+            )
+        _add_to_phase(
+            stats=stats,
+            phase="writing_jobs",
+            wall_time_s=time.time() - phase_start,
+            count=len(batch_jobs),
+            num_bytes=num_bundle_bytes,
         )
+        _log("{:d} bundles".format(len(batch_jobs)))
 
-    _log("Waiting for jobs to finish")
+    session_metrics = metrics.init(
+        session_id=session_id,
+        num_jobs=sum(_num_jobs_in_batch_job(bj) for bj in batch_jobs),
+    )
+    for phase in ["writing_worker_node_script", "writing_jobs"]:
+        if phase in stats:
+            session_metrics["bytes_written"] += stats[phase]["bytes"]
 
-    JB_names_in_session_set = set(JB_names_in_session)
-    still_running = True
-    num_resubmissions_by_idx = {}
-    while still_running:
-        (
-            jobs_running,
-            jobs_pending,
-            jobs_error,
-        ) = _jobs_running_pending_error(
-            JB_names_set=JB_names_in_session_set,
-            error_state_indicator=error_state_indicator,
-            qstat_path=qstat_path,
+    read_result = npy_results.read if memory_map_results else _read_result
+    if memory_map_results:
+        result_num_bytes = npy_results.num_bytes
+    else:
+        result_num_bytes = os.path.getsize
+    if stop_when is None:
+        on_finished = None
+    else:
+        idxs_by_unique_idx = {}
+        for idx, unique_idx in enumerate(unique_idx_by_idx):
+            if unique_idx not in idxs_by_unique_idx:
+                idxs_by_unique_idx[unique_idx] = []
+            idxs_by_unique_idx[unique_idx].append(idx)
+        landed = {
+            "results": [None for job in jobs],
+            "stopped": False,
+            "unique_idxs": set(),
+        }
+        on_finished = functools.partial(
+            _read_landed_results,
+            landed=landed,
+            idxs_by_unique_idx=idxs_by_unique_idx,
+            stop_when=stop_when,
+            work_dir=work_dir,
+            read_result=read_result,
+            session_metrics=session_metrics,
+            result_num_bytes=result_num_bytes,
         )
-        num_running = len(jobs_running)
-        num_pending = len(jobs_pending)
-        num_error = len(jobs_error)
-        num_lost = 0
-        for idx in num_resubmissions_by_idx:
-            if num_resubmissions_by_idx[idx] >= max_num_resubmissions:
-                num_lost += 1
 
+    JB_names_left_in_queue = set()
+    usage_summary = _submit_and_wait(
+        batch_jobs=batch_jobs,
+        num_resubmissions_path=os.path.join(
+            work_dir, "num_resubmissions_by_JB_name.json"
+        ),
+        queue_name=queue_name,
+        python_path=python_path,
+        polling_interval_qstat=polling_interval_qstat,
+        max_num_resubmissions=max_num_resubmissions,
+        qsub_path=qsub_path,
+        qstat_path=qstat_path,
+        qdel_path=qdel_path,
+        error_state_indicator=error_state_indicator,
+        qsub_num_threads=qsub_num_threads,
+        max_num_trials_qsub_qdel=max_num_trials_qsub_qdel,
+        resource_escalation_factor=resource_escalation_factor,
+        max_num_resource_escalations=max_num_resource_escalations,
+        usage_dir=work_dir if measure_usage else None,
+        session_metrics=session_metrics,
+        metrics_json_lines_path=metrics_json_lines_path,
+        metrics_prometheus_textfile_path=metrics_prometheus_textfile_path,
+        stats=stats,
+        on_finished=on_finished,
+        move_pending_jobs_between_queues=move_pending_jobs_between_queues,
+        JB_names_left_in_queue=JB_names_left_in_queue,
+    )
+
+    if usage_summary["num"] > 0:
         _log(
-            "{: 4d} running, {: 4d} pending, {: 4d} error, {: 4d} lost".format(
-                num_running, num_pending, num_error, num_lost,
+            "Observed in {:d} jobs: max. peak-memory {:d} bytes, "
+            "max. wall-time {:.1f} s".format(
+                usage_summary["num"],
+                usage_summary["max_peak_memory_bytes"],
+                usage_summary["max_wall_time_s"],
             )
         )
 
-        for job in jobs_error:
-            idx = _idx_from_JB_name(job["JB_name"])
-            if idx in num_resubmissions_by_idx:
-                num_resubmissions_by_idx[idx] += 1
+    _log("Scanning work_dir")
+    phase_start = time.time()
+    work_dir_sizes = _scan_work_dir(work_dir=work_dir)
+    job_status_table = _job_status_table(
+        work_dir_sizes=work_dir_sizes, idxs=unique_idxs,
+    )
+    _add_to_phase(
+        stats=stats,
+        phase="scanning_work_dir",
+        wall_time_s=time.time() - phase_start,
+        count=1,
+    )
+
+    _log("Reducing results from work_dir")
+    phase_start = time.time()
+
+    bytes_read_before_reducing = session_metrics["bytes_read"]
+    stopped_early = stop_when is not None and landed["stopped"]
+    if stopped_early:
+        _log("Stopped early, results are expected to be incomplete")
+
+    job_status_by_idx = {js["idx"]: js for js in job_status_table}
+    result_paths = []
+    results_are_incomplete = False
+    for idx in range(len(jobs)):
+        job_status = job_status_by_idx[unique_idx_by_idx[idx]]
+        result_path = _job_path(work_dir, job_status["idx"]) + ".out"
+        if job_status["result_size"] is None:
+            if not stopped_early:
+                results_are_incomplete = True
+                _log("No result ", result_path)
+            result_paths.append(None)
+        else:
+            result_paths.append(result_path)
+
+    num_result_bytes = sum(
+        [js["result_size"] for js in job_status_table if js["result_size"]]
+    )
+
+    reduce_jobs_succeeded = True
+    if stop_when is not None:
+        # Results which landed after the last call of qstat.
+        for job_status in job_status_table:
+            unique_idx = job_status["idx"]
+            if job_status["result_size"] is None:
+                continue
+            if unique_idx in landed["unique_idxs"]:
+                continue
+            result = read_result(_job_path(work_dir, unique_idx) + ".out")
+            session_metrics["bytes_read"] += job_status["result_size"]
+            landed["unique_idxs"].add(unique_idx)
+            for idx in idxs_by_unique_idx[unique_idx]:
+                landed["results"][idx] = result
+        results = landed["results"]
+    elif reducer is None:
+        unique_result_paths = []
+        for job_status in job_status_table:
+            if job_status["result_size"] is not None:
+                unique_result_paths.append(
+                    _job_path(work_dir, job_status["idx"]) + ".out"
+                )
+        unique_results_iter = _read_results(
+            result_paths=unique_result_paths,
+            num_workers=reduce_num_workers,
+            pool=reduce_pool,
+            read_result=read_result,
+        )
+        results_by_path = dict(zip(unique_result_paths, unique_results_iter))
+        results = []
+        for result_path in result_paths:
+            if result_path is None:
+                results.append(None)
             else:
-                num_resubmissions_by_idx[idx] = 1
+                results.append(results_by_path[result_path])
+        del results_by_path
+        session_metrics["bytes_read"] += num_result_bytes
+    elif tree_reduce_group_size is not None:
+        _log("Reducing results in a tree of reduce-jobs")
+        results, reduce_jobs_succeeded = _tree_reduce(
+            reducer=reducer,
+            result_paths=[path for path in result_paths if path is not None],
+            group_size=tree_reduce_group_size,
+            work_dir=work_dir,
+            session_id=session_id,
+            queue_name=queue_name,
+            python_path=python_path,
+            polling_interval_qstat=polling_interval_qstat,
+            max_num_resubmissions=max_num_resubmissions,
+            qsub_path=qsub_path,
+            qstat_path=qstat_path,
+            qdel_path=qdel_path,
+            error_state_indicator=error_state_indicator,
+            qsub_num_threads=qsub_num_threads,
+            max_num_trials_qsub_qdel=max_num_trials_qsub_qdel,
+            stats=stats,
+            session_metrics=session_metrics,
+        )
+    else:
+        results = _fold_results(
+            reducer=reducer,
+            result_paths=result_paths,
+            read_results=functools.partial(
+                _read_results,
+                num_workers=reduce_num_workers,
+                pool=reduce_pool,
+                read_result=read_result,
+            ),
+        )
+        session_metrics["bytes_read"] += num_result_bytes
+
+    _add_to_phase(
+        stats=stats,
+        phase="reducing",
+        wall_time_s=time.time() - phase_start,
+        count=len(result_paths),
+        num_bytes=session_metrics["bytes_read"] - bytes_read_before_reducing,
+    )
 
-            job_id_str = "JB_name {:s}, JB_job_number {:s}, idx {:09d}".format(
-                job["JB_name"], job["JB_job_number"], idx
+    metrics.export(
+        metrics=session_metrics,
+        json_lines_path=metrics_json_lines_path,
+        prometheus_textfile_path=metrics_prometheus_textfile_path,
+    )
+
+    if stopped_early:
+        # Deleted jobs which did not start yet have no stderr.
+        job_status_table_stderr = []
+        for job_status in job_status_table:
+            if job_status["stderr_size"] is not None:
+                job_status_table_stderr.append(job_status)
+    else:
+        job_status_table_stderr = job_status_table
+
+    has_stderr = False
+    if _has_invalid_or_non_empty_stderr(job_status_table_stderr):
+        has_stderr = True
+        _log("Found non zero stderr")
+
+    if num_jobs_per_batch_job > 1:
+        for batch_job in batch_jobs:
+            stderr_size = work_dir_sizes.get(
+                os.path.basename(batch_job["stderr_path"]), None
             )
-            _log("Found error-state in ", job_id_str)
-            _log("Deleting ", job_id_str)
+            if stderr_size is None and stopped_early:
+                continue
+            if stderr_size != 0:
+                has_stderr = True
+                _log("Found non zero stderr of bundle ", batch_job["JB_name"])
+
+    if memory_map_results:
+        _log("The results are memory-mapped from the work_dir")
+    if JB_names_left_in_queue:
+        _log("Jobs might still write into the work_dir")
+    if (
+        has_stderr
+        or keep_work_dir
+        or results_are_incomplete
+        or not reduce_jobs_succeeded
+        or memory_map_results
+        or JB_names_left_in_queue
+    ):
+        _log("Keeping work_dir: ", work_dir)
+        nfs.write(
+            content=json.dumps(job_status_table, indent=4),
+            path=os.path.join(work_dir, "job_status_table.json"),
+            mode="wt",
+        )
+    else:
+        _log("Removing work_dir: ", work_dir)
+        phase_start = time.time()
+        if remove_work_dir_in_background:
+            _move_to_trash_and_remove_in_background(work_dir=work_dir)
+        else:
+            shutil.rmtree(work_dir)
+        _add_to_phase(
+            stats=stats,
+            phase="removing_work_dir",
+            wall_time_s=time.time() - phase_start,
+            count=1,
+        )
 
-            _qdel(JB_job_number=job["JB_job_number"], qdel_path=qdel_path)
+    for phase in stats:
+        _log(
+            "Phase {:s}: {:.3f} s, count {:d}, {:d} bytes".format(
+                phase,
+                stats[phase]["wall_time_s"],
+                stats[phase]["count"],
+                stats[phase]["bytes"],
+            )
+        )
 
-            if num_resubmissions_by_idx[idx] <= max_num_resubmissions:
-                _log(
-                    "Resubmitting {:d} of {:d}, JB_name {:s}".format(
-                        num_resubmissions_by_idx[idx],
-                        max_num_resubmissions,
-                        job["JB_name"],
-                    )
-                )
-                _qsub(
-                    qsub_path=qsub_path,
-                    queue_name=queue_name,
-                    script_exe_path=python_path,
-                    script_path=script_path,
-                    arguments=[_job_path(work_dir, idx)],
-                    JB_name=job["JB_name"],
-                    stdout_path=_job_path(work_dir, idx) + ".o",
-                    stderr_path=_job_path(work_dir, idx) + ".e",
-                )
+    _log("Stop map()")
 
-        if jobs_error:
-            nfs.write(
-                content=json.dumps(num_resubmissions_by_idx, indent=4),
-                path=os.path.join(work_dir, "num_resubmissions_by_idx.json"),
-                mode="wt",
+    if return_stats:
+        return results, stats
+    return results
+
+
+def pipeline(
+    functions,
+    jobs,
+    queue_name=None,
+    python_path=os.path.abspath(shutil.which("python")),
+    polling_interval_qstat=5,
+    work_dir=None,
+    keep_work_dir=False,
+    max_num_resubmissions=10,
+    qsub_path="qsub",
+    qstat_path="qstat",
+    qdel_path="qdel",
+    error_state_indicator="E",
+    qsub_num_threads=1,
+    max_num_trials_qsub_qdel=10,
+):
+    """
+    Maps jobs through a chain of functions, i.e. stages, on a qsub
+    computing-cluster.
+
+    This for loop:
+
+    >    results = []
+    >    for job in jobs:
+    >        result = job
+    >        for function in functions:
+    >            result = function(result)
+    >        results.append(result)
+
+    will be executed in parallel on a qsub computing-cluster in order to obtain
+    results.
+    The intermediate results stay in the work_dir. The worker-node-script of
+    stage k+1 reads the result of stage k directly from
+    work_dir/stage_{k:02d}/{idx:09d}.pkl.out. A job's next stage is
+    submitted as soon as its stage before finished, and not after the whole
+    stage finished.
+
+    Parameters
+    ----------
+    functions : list of function-pointers
+        The stages. Each function must be part of an installed python-module.
+        The result of a function must be a valid input to the next function.
+    jobs : list
+        List of jobs. A job in the list must be a valid input to the first
+        function.
+    max_num_resubmissions: int, optional
+        In case of error-state in job, the job will be tried this often to be
+        resubmitted befor giving up on it. This is shared by all stages of a
+        job.
+
+    All other parameters are the same as in map().
+    A job which failed in one stage is not processed further, and its result
+    is None.
+
+    Example
+    -------
+    results = pipeline(
+        functions=[numpy.cumsum, numpy.sum],
+        jobs=[numpy.arange(i, 100+i) for i in range(10)]
+    )
+    """
+    assert len(functions) >= 1
+    session_id = _session_id_from_time_now()
+    if work_dir is None:
+        work_dir = os.path.abspath(os.path.join(".", ".qsub_" + session_id))
+    num_stages = len(functions)
+
+    _log("Start pipeline()")
+    _log("qsub_path:  ", qsub_path)
+    _log("qstat_path: ", qstat_path)
+    _log("qdel_path:  ", qdel_path)
+    _log("queue_name: ", queue_name)
+    _log("python_path: ", python_path)
+    _log("polling-interval for qstat: ", polling_interval_qstat, "s")
+    _log("max. num. resubmissions: ", max_num_resubmissions)
+    _log("error-state-indicator: ", error_state_indicator)
+    _log("qsub-num-threads: ", qsub_num_threads)
+    _log("max. num. trials qsub, qdel: ", max_num_trials_qsub_qdel)
+    _log("num. stages: ", num_stages)
+    _log("Making work_dir ", work_dir)
+    os.makedirs(work_dir)
+
+    environ = dict(os.environ)
+    for stage, function in enumerate(functions):
+        stage_dir = _stage_dir(work_dir, stage)
+        os.makedirs(stage_dir)
+        script_path = os.path.join(stage_dir, "worker_node_script.py")
+        _log("Writing worker-node-script", script_path)
+        nfs.write(
+            content=_make_worker_node_script(
+                module_name=function.__module__,
+                function_name=function.__name__,
+                environ=environ,
+                job_input_dir=(
+                    None if stage == 0 else _stage_dir(work_dir, stage - 1)
+                ),
+            ),
+            path=script_path,
+            mode="wt",
+        )
+        _make_path_executable(path=script_path)
+
+    _log("Mapping jobs into work_dir")
+    batch_jobs = []
+    for idx, job in enumerate(jobs):
+        nfs.write(
+            content=pickle.dumps(job),
+            path=_job_path(_stage_dir(work_dir, 0), idx),
+            mode="wb",
+        )
+        batch_jobs.append(
+            _make_stage_batch_job(
+                work_dir=work_dir, session_id=session_id, stage=0, idx=idx,
             )
+        )
 
-        if num_running == 0 and num_pending == 0:
-            still_running = False
+    _submit_and_wait(
+        batch_jobs=batch_jobs,
+        num_resubmissions_path=os.path.join(
+            work_dir, "num_resubmissions_by_JB_name.json"
+        ),
+        queue_name=queue_name,
+        python_path=python_path,
+        polling_interval_qstat=polling_interval_qstat,
+        max_num_resubmissions=max_num_resubmissions,
+        qsub_path=qsub_path,
+        qstat_path=qstat_path,
+        qdel_path=qdel_path,
+        error_state_indicator=error_state_indicator,
+        qsub_num_threads=qsub_num_threads,
+        max_num_trials_qsub_qdel=max_num_trials_qsub_qdel,
+        next_batch_jobs=functools.partial(
+            _next_stage_batch_jobs,
+            work_dir=work_dir,
+            session_id=session_id,
+            num_stages=num_stages,
+        ),
+    )
 
-        time.sleep(polling_interval_qstat)
+    _log("Scanning work_dir")
+    has_stderr = False
+    idxs_reached_stage = list(range(len(jobs)))
+    for stage in range(num_stages):
+        work_dir_sizes = _scan_work_dir(work_dir=_stage_dir(work_dir, stage))
+        stage_status_table = _job_status_table(
+            work_dir_sizes=work_dir_sizes, idxs=idxs_reached_stage,
+        )
+        if _has_invalid_or_non_empty_stderr(stage_status_table):
+            has_stderr = True
+            _log("Found non zero stderr in stage ", stage)
+        idxs_reached_stage = []
+        for job_status in stage_status_table:
+            if job_status["result_size"] is not None:
+                idxs_reached_stage.append(job_status["idx"])
+    job_status_table = _job_status_table(
+        work_dir_sizes=work_dir_sizes, idxs=range(len(jobs)),
+    )
 
     _log("Reducing results from work_dir")
-
-    results = []
+    result_paths = []
     results_are_incomplete = False
-    for idx, job in enumerate(jobs):
-        try:
-            result_path = _job_path(work_dir, idx) + ".out"
-            result = pickle.loads(nfs.read(path=result_path, mode="rb"))
-            results.append(result)
-        except FileNotFoundError:
+    for job_status in job_status_table:
+        result_path = (
+            _job_path(_stage_dir(work_dir, num_stages - 1), job_status["idx"])
+            + ".out"
+        )
+        if job_status["result_size"] is None:
             results_are_incomplete = True
             _log("No result ", result_path)
-            results.append(None)
-
-    has_stderr = False
-    if _has_invalid_or_non_empty_stderr(work_dir=work_dir, num_jobs=len(jobs)):
-        has_stderr = True
-        _log("Found non zero stderr")
+            result_paths.append(None)
+        else:
+            result_paths.append(result_path)
+    results = list(_read_results(result_paths=result_paths))
 
     if has_stderr or keep_work_dir or results_are_incomplete:
         _log("Keeping work_dir: ", work_dir)
+        nfs.write(
+            content=json.dumps(job_status_table, indent=4),
+            path=os.path.join(work_dir, "job_status_table.json"),
+            mode="wt",
+        )
     else:
         _log("Removing work_dir: ", work_dir)
         shutil.rmtree(work_dir)
 
-    _log("Stop map()")
-
+    _log("Stop pipeline()")
     return results
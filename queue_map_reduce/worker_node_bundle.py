@@ -0,0 +1,144 @@
+"""
+Processing a bundle of jobs within a single batch-job
+-----------------------------------------------------
+
+Some queues only hand out whole worker-nodes, or multiple slots in a
+parallel environment. To use all of these slots, a single batch-job can
+process a bundle of jobs using a pool of processes.
+
+The bundle is a json-file with the list of the jobs' paths. Each job is
+processed just like the worker-node-script would do it. The job's stdout and
+stderr are written to the job's own {idx:09d}.pkl.o and {idx:09d}.pkl.e so
+that map() can inspect each job on its own. A job which already has its
+result, e.g. from an earlier run of a resubmitted bundle, is skipped.
+"""
+import json
+import mmap
+import os
+import pickle
+import resource
+import sys
+import time
+import traceback
+import multiprocessing
+from . import network_file_system as nfs
+from . import npy_results as npy
+
+_worker = {}
+
+
+def run(
+    function,
+    bundle_path,
+    num_processes,
+    shared_path=None,
+    worker_node_tmp_dir=None,
+    measure_usage=False,
+    npy_results=False,
+):
+    """
+    Processes all jobs in the bundle using a pool of num_processes.
+    With npy_results, the results are written using
+    queue_map_reduce.npy_results.write(), and are moved out of the
+    worker_node_tmp_dir using queue_map_reduce.npy_results.move().
+    """
+    start_time = time.time()
+    job_paths = json.loads(nfs.read(bundle_path, mode="rt"))
+
+    with multiprocessing.Pool(
+        processes=num_processes,
+        initializer=_init_worker,
+        initargs=(function, shared_path, worker_node_tmp_dir, npy_results),
+    ) as pool:
+        pool.map(_run_job, job_paths, chunksize=1)
+
+    if measure_usage:
+        peak_rss_kib = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        )
+        usage = {
+            "peak_memory_bytes": 1024 * peak_rss_kib,
+            "wall_time_s": time.time() - start_time,
+        }
+        nfs.write(json.dumps(usage), bundle_path + ".usage", mode="wt")
+
+
+def _init_worker(function, shared_path, worker_node_tmp_dir, npy_results):
+    """
+    Runs once in each process of the pool. The shared payload is read only
+    once per process.
+    """
+    _worker["function"] = function
+    _worker["worker_node_tmp_dir"] = worker_node_tmp_dir
+    _worker["npy_results"] = npy_results
+    if shared_path is None:
+        _worker["has_shared"] = False
+    else:
+        _worker["has_shared"] = True
+        with open(shared_path, mode="rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                _worker["shared"] = pickle.loads(m)
+
+
+def _run_job(job_path):
+    """
+    Processes the job with its stdout and stderr redirected into the job's
+    own files. Both python's sys.stdout, sys.stderr and the file-descriptors
+    1, 2 are redirected to also catch the output of extensions.
+    """
+    if os.path.exists(job_path + ".out"):
+        return
+    original_sys_stdout = sys.stdout
+    original_sys_stderr = sys.stderr
+    original_sys_stdout.flush()
+    original_sys_stderr.flush()
+    original_stdout = os.dup(1)
+    original_stderr = os.dup(2)
+    with open(job_path + ".o", "wt") as o, open(job_path + ".e", "wt") as e:
+        os.dup2(o.fileno(), 1)
+        os.dup2(e.fileno(), 2)
+        sys.stdout = o
+        sys.stderr = e
+        try:
+            _process_job(job_path=job_path)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            o.flush()
+            e.flush()
+            sys.stdout = original_sys_stdout
+            sys.stderr = original_sys_stderr
+            os.dup2(original_stdout, 1)
+            os.dup2(original_stderr, 2)
+    os.close(original_stdout)
+    os.close(original_stderr)
+
+
+def _process_job(job_path):
+    tmp_dir = _worker["worker_node_tmp_dir"]
+    if tmp_dir:
+        local_job_path = os.path.join(tmp_dir, os.path.basename(job_path))
+        nfs.copy(job_path, local_job_path)
+    else:
+        local_job_path = job_path
+    job = pickle.loads(nfs.read(local_job_path, mode="rb"))
+
+    if _worker["has_shared"]:
+        result = _worker["function"](job, _worker["shared"])
+    else:
+        result = _worker["function"](job)
+
+    if _worker["npy_results"] and tmp_dir:
+        npy.write(result=result, path=local_job_path + ".out")
+        npy.move(src=local_job_path + ".out", dst=job_path + ".out")
+    elif _worker["npy_results"]:
+        npy.write(result=result, path=job_path + ".out")
+    elif tmp_dir:
+        with open(local_job_path + ".out", "wb") as f:
+            f.write(pickle.dumps(result))
+        nfs.move(local_job_path + ".out", job_path + ".out")
+    else:
+        nfs.write(pickle.dumps(result), job_path + ".out", mode="wb")
+    if tmp_dir:
+        os.remove(local_job_path)
@@ -0,0 +1,52 @@
+"""
+A cache for read-only input-files on the local disk of a worker-node
+--------------------------------------------------------------------
+
+When many jobs read the same large input-files, each job would read these
+over the network-file-system again and again. Instead, your function can ask
+for a local copy of the input-file:
+
+    from queue_map_reduce import worker_node_cache
+
+    def function(job):
+        path = worker_node_cache.local_path(job["input_path"])
+        ...
+
+The first job on a worker-node copies the input-file into the cache_dir. All
+following jobs on this worker-node read the local copy. The copy is addressed
+by the input-file's absolute path, size, and time of last modification. So a
+modified input-file will be copied again.
+
+The cache_dir is set by map(worker_node_cache_dir=...). When it is not set,
+local_path(path) returns path.
+"""
+import os
+import hashlib
+from . import network_file_system as nfs
+
+CACHE_DIR_KEY = "QUEUE_MAP_REDUCE_WORKER_NODE_CACHE_DIR"
+
+
+def _cache_key(path):
+    st = os.stat(path)
+    key = "{:s}:{:d}:{:d}".format(
+        os.path.abspath(path), st.st_size, st.st_mtime_ns
+    )
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def local_path(path):
+    """
+    Returns the path to a local copy of the read-only file in path.
+    Copies the file into the cache_dir when it is not there yet.
+    """
+    cache_dir = os.environ.get(CACHE_DIR_KEY, "")
+    if not cache_dir:
+        return path
+
+    entry_dir = os.path.join(cache_dir, _cache_key(path))
+    cached_path = os.path.join(entry_dir, os.path.basename(path))
+    if not os.path.exists(cached_path):
+        os.makedirs(entry_dir, exist_ok=True)
+        nfs.copy(src=path, dst=cached_path)
+    return cached_path